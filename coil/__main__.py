@@ -31,6 +31,8 @@ u"""Coil CMS v{0}
 Usage:
   coil devserver [-b | --browser] [-p <port> | --port=<port>] [--no-url-fix] [--no-debug]
   coil unlock
+  coil watch [--debounce=<seconds>]
+  coil worker [--burst] [--threads=<n> --url=<url>]
   coil write_users
   coil -h | --help
   coil --version
@@ -40,6 +42,10 @@ Options:
  --version                 Show version.
  -b, --browser             Open Coil CMS in the browser after starting.
  -p <port>, --port=<port>  Port to use [default: 8001].
+ --debounce=<seconds>      Seconds to wait for more changes [default: 1].
+ --burst                   Quit when there are no more jobs.
+ --threads=<n>             Run <n> jobs at once, for any site.
+ --url=<url>               Redis URL of the queue.
 """
 
 from __future__ import unicode_literals
@@ -63,6 +69,10 @@ def main():
         sys.exit(devserver(arguments))
     elif arguments['unlock']:
         sys.exit(unlock(arguments))
+    elif arguments['watch']:
+        sys.exit(watch(arguments))
+    elif arguments['worker']:
+        sys.exit(worker(arguments))
 
 
 def init(arguments):
@@ -103,9 +113,25 @@ def unlock(arguments):
     import redis
     u = coil.utils.ask("Redis URL", "redis://localhost:6379/0")
     db = redis.StrictRedis.from_url(u)
-    db.set('site:lock', 0)
+    db.delete('site:lock')
+    # Wake up anyone waiting for the lock.
+    db.rpush('site:lock:signal', '1')
+    db.expire('site:lock:signal', 60)
     print("Database unlocked.")
     return 0
 
+
+def watch(arguments):
+    """Watch the site for changes."""
+    import coil.watch
+    return coil.watch.watch(float(arguments['--debounce']))
+
+
+def worker(arguments):
+    """Run a build worker."""
+    import coil.worker
+    threads = int(arguments['--threads'] or 0)
+    return coil.worker.work(arguments['--burst'], threads, arguments['--url'])
+
 if __name__ == '__main__':
     main()
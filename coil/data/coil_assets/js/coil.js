@@ -20,3 +20,377 @@ function save_fail_anim() {
         $(".save-icon").removeClass("fa-times").addClass("fa-save");
     }, 2000);
 }
+
+function rebuild_progress(api_url, stream_url) {
+    var pb = $('#progressbar');
+    var fs = $('.build-status-icon');
+    var fsc = $('.build-status-caption');
+    var outputs = {'build': $('#outputb'), 'orphans': $('#outputo')};
+    var offsets = {'build_offset': 0, 'orphans_offset': 0};
+    var meta = {'build': {}, 'orphans': {}};
+    var pipeline = null;
+    var done = false;
+    var delay = 500;
+
+    function set_bar(current, max) {
+        var perc = 100 * current / max;
+        if (isNaN(perc)) {
+            perc = 0;
+        }
+        pb.attr('aria-valuenow', Math.ceil(perc));
+        pb.attr('style', 'width: ' + perc + '%');
+        pb.html(Math.ceil(perc) + '%');
+        if (current == max) {
+            pb.removeClass('active');
+        }
+        if (perc == 0) {
+            pb.attr('style', 'width: ' + perc + '%; color: black;');
+        }
+    }
+
+    function format_eta(seconds) {
+        if (seconds < 60) {
+            return seconds + ' s';
+        }
+        return Math.ceil(seconds / 60) + ' min';
+    }
+
+    // Returns false if some lines were missed.  If the API skips lines, they
+    // are gone (only the last lines are kept in Limited Mode).
+    function append_log(name, lines, offset, from_api) {
+        var seen = offsets[name + '_offset'];
+        if (offset > seen && from_api) {
+            if (seen == 0) {
+                outputs[name].text('');
+            }
+            outputs[name].append(document.createTextNode('…\n'));
+            offsets[name + '_offset'] = seen = offset;
+        } else if (offset > seen) {
+            return false;
+        }
+        lines = lines.slice(seen - offset);
+        if (lines.length == 0) {
+            return true;
+        }
+        if (seen == 0) {
+            outputs[name].text('');
+        }
+        outputs[name].append(document.createTextNode(lines.join('\n') + '\n'));
+        offsets[name + '_offset'] += lines.length;
+        return true;
+    }
+
+    // A follow-up build replaced the one being displayed.
+    function reset() {
+        offsets.build_offset = 0;
+        offsets.orphans_offset = 0;
+        meta = {'build': {}, 'orphans': {}};
+        outputs.build.text('');
+        outputs.orphans.text('');
+        pb.removeClass('progress-bar-success progress-bar-danger').addClass('active');
+        fs.removeClass('fa-check fa-times').addClass('fa-cog');
+        fsc.removeClass('text-success text-danger');
+        done = false;
+    }
+
+    // Returns false if some lines were missed.
+    function update(data, from_api) {
+        var complete = true;
+        if (data.pipeline !== undefined && data.pipeline !== pipeline) {
+            if (pipeline !== null) {
+                reset();
+            }
+            pipeline = data.pipeline;
+        }
+        if (data.build_log !== undefined) {
+            complete = append_log('build', data.build_log, data.build_offset, from_api) && complete;
+        }
+        if (data.orphans_log !== undefined) {
+            complete = append_log('orphans', data.orphans_log, data.orphans_offset, from_api) && complete;
+        }
+        if (data.build !== undefined) {
+            meta.build = data.build;
+        }
+        if (data.orphans !== undefined) {
+            meta.orphans = data.orphans;
+        }
+        set_bar(meta.build.done, meta.build.total + 1);
+        if (meta.build.task) {
+            var status = meta.build.done + ' of ' + meta.build.total + ' tasks: ' + meta.build.task;
+            if (meta.build.eta !== null && meta.build.eta !== undefined) {
+                status += ' (about ' + format_eta(meta.build.eta) + ' left)';
+            }
+            $('#build-task').text(status);
+        } else if (meta.build.status !== null && meta.build.status !== undefined) {
+            $('#build-task').text('');
+        }
+        if (meta.orphans.status === true) {
+            set_bar(1, 1);
+            pb.addClass('progress-bar-success');
+            fs.removeClass('fa-cog');
+            fs.addClass('fa-check');
+            fsc.addClass('text-success');
+            done = true;
+        }
+        if (meta.build.cancelled) {
+            $('#build-task').text('Superseded by a forced build, which starts next.');
+        } else if (meta.build.status === false || meta.orphans.status === false) {
+            pb.addClass('progress-bar-danger');
+            fs.removeClass('fa-cog');
+            fs.addClass('fa-times');
+            fsc.addClass('text-danger');
+            $("#collapseOutput").collapse({
+                show: true
+            });
+            done = true;
+        }
+        return complete;
+    }
+
+    function fetch(callback) {
+        $.ajax({
+            "url": api_url,
+            "data": offsets,
+            "dataType": "json",
+        }).done(function(data) {
+            var seen = offsets.build_offset + offsets.orphans_offset;
+            update(data, true);
+            callback(offsets.build_offset + offsets.orphans_offset > seen);
+        }).fail(function() {
+            callback(false);
+        });
+    }
+
+    // Poll, backing off while nothing happens.
+    function poll() {
+        fetch(function(changed) {
+            if (done) {
+                return;
+            }
+            delay = changed ? 500 : Math.min(delay * 2, 5000);
+            setTimeout(poll, delay);
+        });
+    }
+
+    if (window.EventSource === undefined) {
+        poll();
+        return;
+    }
+    var source = new EventSource(stream_url);
+    source.onmessage = function(e) {
+        if (!update(JSON.parse(e.data))) {
+            fetch(function() {});
+        }
+        // The server ends the stream when there is no follow-up build.
+    };
+    source.onerror = function() {
+        source.close();
+        if (!done) {
+            poll();
+        }
+    };
+}
+
+function publish_progress(api_url) {
+    var alert = $('#publish-status');
+    var output = $('#publish-log');
+    var offset = 0;
+
+    function poll() {
+        $.getJSON(api_url, {'offset': offset}, function(data) {
+            if (data.offset > offset) {
+                output.append(document.createTextNode('…\n'));
+            }
+            if (data.log.length > 0) {
+                output.append(document.createTextNode(data.log.join('\n') + '\n'));
+            }
+            offset = data.offset + data.log.length;
+            if (data.publish.status === true) {
+                alert.removeClass('alert-info').addClass('alert-success');
+                alert.find('.publish-message').text('The pages of this post have been built.  Other pages will be updated by the next full rebuild.');
+            } else if (data.publish.status === false) {
+                alert.removeClass('alert-info').addClass('alert-danger');
+                alert.find('.fa').removeClass('fa-globe').addClass('fa-warning');
+                alert.find('.publish-message').text('Building the pages of this post failed.  Try a full rebuild.');
+                $('#publish-output').collapse('show');
+            } else {
+                setTimeout(poll, 1000);
+            }
+        }).fail(function() {
+            setTimeout(poll, 5000);
+        });
+    }
+
+    poll();
+}
+
+function permissions_editor(api_url, permissions, uids, current_uid) {
+    var BLOCK = 100;
+    var scroller = $('.permissions-scroll');
+    var tbody = $('#permissions-rows');
+    var row_height = 41;
+    var blocks = {};    // block number → users by UID (false while loading)
+    var changes = {};   // UID → {permission: value}
+    // Permissions the current user cannot take away from themselves.
+    var locked = ['active', 'is_admin', 'must_change_password'];
+
+    function css_name(p) {
+        // .active is significant in Bootstrap, so we're changing the name here
+        return p == 'active' ? 'is_active' : p;
+    }
+
+    function perm_name(name) {
+        return name == 'is_active' ? 'active' : name;
+    }
+
+    function set(uid, p, value) {
+        if (uid == current_uid && locked.indexOf(p) != -1) {
+            return;
+        }
+        if (changes[uid] === undefined) {
+            changes[uid] = {};
+        }
+        changes[uid][p] = value;
+    }
+
+    function value(user, p) {
+        var c = changes[user.uid];
+        if (c !== undefined && c[p] !== undefined) {
+            return c[p];
+        }
+        return user.permissions[p];
+    }
+
+    function load(block) {
+        if (blocks[block] !== undefined) {
+            return;
+        }
+        blocks[block] = false;
+        var ids = uids.slice(block * BLOCK, (block + 1) * BLOCK);
+        $.getJSON(api_url, {'uids': ids.join(',')}, function(data) {
+            var users = {};
+            $.each(data.users, function(i, user) { users[user.uid] = user; });
+            blocks[block] = users;
+            render();
+        }).fail(function() {
+            delete blocks[block];
+        });
+    }
+
+    function user_row(uid, user) {
+        var tr = $('<tr class="user-row">').addClass('u' + uid);
+        tr.append($('<td class="uid">').text(uid));
+        tr.append($('<td class="username">').text(user ? user.username : '…'));
+        $.each(permissions, function(i, p) {
+            var td = $('<td class="perm">').addClass(css_name(p));
+            if (user) {
+                var checked = value(user, p);
+                if (p == 'wants_all_posts' && !value(user, 'can_edit_all_posts')) {
+                    // If this happens, permissions are damaged.
+                    checked = false;
+                }
+                td.append($('<input type="checkbox">').addClass('u' + uid)
+                    .attr('data-uid', uid).attr('data-perm', css_name(p))
+                    .prop('checked', checked)
+                    .prop('disabled', uid == current_uid && locked.indexOf(p) != -1));
+            }
+            tr.append(td);
+        });
+        var td = $('<td class="select_all">');
+        if (user) {
+            td.append('<button type="button" class="btn btn-sm btn-info select_all-user" data-uid="' + uid + '"><i class="fa fa-check-square-o fa-fw"></i></button> ');
+            td.append('<button type="button" class="btn btn-sm btn-info select_none-user" data-uid="' + uid + '"><i class="fa fa-square-o fa-fw"></i></button>');
+        }
+        return tr.append(td);
+    }
+
+    function spacer(rows) {
+        return $('<tr class="spacer">').append(
+            $('<td>').attr('colspan', permissions.length + 3)
+                .css({'height': rows * row_height, 'padding': 0, 'border': 0}));
+    }
+
+    // Render only the rows in view (and a few around them).
+    function render() {
+        var top = scroller.scrollTop() - scroller.find('thead').outerHeight();
+        var first = Math.max(0, Math.floor(top / row_height) - 10);
+        var last = Math.min(uids.length,
+                            first + Math.ceil(scroller.height() / row_height) + 20);
+        var rows = [spacer(first)];
+        for (var i = first; i < last; i++) {
+            var block = Math.floor(i / BLOCK);
+            load(block);
+            var users = blocks[block];
+            rows.push(user_row(uids[i], users ? users[uids[i]] : null));
+        }
+        rows.push(spacer(uids.length - last));
+        tbody.empty().append(rows);
+        var measured = tbody.children('tr.user-row').first().outerHeight();
+        if (measured && measured != row_height) {
+            row_height = measured;
+            render();
+        }
+    }
+
+    function set_all(select_uids, p, checked) {
+        $.each(select_uids, function(i, uid) { set(uid, p, checked); });
+        render();
+    }
+
+    tbody.on('change', 'input', function() {
+        set(parseInt(this.attributes['data-uid'].value, 10),
+            perm_name(this.attributes['data-perm'].value), this.checked);
+    });
+    tbody.on('click', 'button.select_all-user, button.select_none-user', function() {
+        var uid = parseInt(this.attributes['data-uid'].value, 10);
+        var checked = $(this).hasClass('select_all-user');
+        $.each(permissions, function(i, p) { set(uid, p, checked); });
+        render();
+    });
+    $('th button.select_all-perm').click(function() {
+        set_all(uids, perm_name(this.attributes['data-perm'].value), true);
+    });
+    $('th button.select_none-perm').click(function() {
+        set_all(uids, perm_name(this.attributes['data-perm'].value), false);
+    });
+    tbody.closest('form').submit(function() {
+        $('#permissions-changes').val(JSON.stringify(changes));
+    });
+
+    var scheduled = false;
+    scroller.scroll(function() {
+        if (!scheduled) {
+            scheduled = true;
+            setTimeout(function() {
+                scheduled = false;
+                render();
+            }, 50);
+        }
+    });
+    render();
+}
+
+function author_picker(api_url) {
+    var select = $('select[name="author.uid"]');
+    var search = $('#author-search');
+    var timer = null;
+
+    function show(users) {
+        var selected = select.find('option:selected');
+        select.find('option').not(selected).remove();
+        $.each(users, function(i, user) {
+            if (user.uid != selected.val()) {
+                select.append($('<option>').val(user.uid).text(user.realname));
+            }
+        });
+    }
+
+    search.on('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(function() {
+            $.getJSON(api_url, {'q': search.val()}, function(data) {
+                show(data.users);
+            });
+        }, 300);
+    });
+}
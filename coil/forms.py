@@ -54,6 +54,11 @@ class DeleteForm(Form):
     path = TextField('Path', validators=[Required()])
 
 
+class PublishForm(Form):
+    """A post publishing form, used for CSRF protection only."""
+    pass
+
+
 class UserDeleteForm(Form):
     """An user deletion form."""
     direction = TextField('Direction', validators=[Required()])
@@ -56,6 +56,9 @@ def write_users(dburl):
     db = redis.StrictRedis.from_url(dburl)
     db.hmset('user:1', data)
     db.hset('users', 'admin', '1')
+    db.publish('users:changed', '1')
+    # The user indexes will be rebuilt when needed.
+    db.delete('users:indexed')
     if not db.exists('last_uid'):
         db.incr('last_uid')
 
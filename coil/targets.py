@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+
+# Coil CMS v1.2.0
+# Copyright © 2014-2018 Chris Warrick, Roberto Alsina, Henry Hirsch et al.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Run Nikola, recording the targets of all its tasks.
+
+Usage: ``python -m coil.targets <file> <nikola arguments>``
+"""
+
+from __future__ import print_function, unicode_literals
+import io
+import os
+import sys
+
+import nikola.__main__
+
+__all__ = ['record_targets']
+
+
+def record_targets(path):
+    """Make Nikola write the targets of its tasks to a file.
+
+    The file lists absolute paths, one per line.  It is written when the
+    tasks are loaded, so it lists every output file of the site, even if
+    the command only runs some tasks.
+
+    :param str path: File to write to
+    """
+    load_tasks = nikola.__main__.NikolaTaskLoader.load_tasks
+
+    def _load_tasks(self, *args, **kwargs):
+        tasks, config = load_tasks(self, *args, **kwargs)
+        with io.open(path, 'w', encoding='utf-8') as fh:
+            for task in tasks:
+                for target in task.targets:
+                    fh.write(os.path.abspath(target) + '\n')
+        return tasks, config
+
+    nikola.__main__.NikolaTaskLoader.load_tasks = _load_tasks
+
+
+def main(args):
+    """Run Nikola with ``args[1:]``, writing targets to ``args[0]``."""
+    record_targets(args[0])
+    return nikola.__main__.main(args[1:])
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
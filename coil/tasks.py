@@ -25,114 +25,1020 @@
 # OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+import collections
+import io
+import json
+import re
 import subprocess
 import os
-from rq import get_current_job
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+import nikola.__main__
+import nikola.utils
+from rq import Queue, get_current_job
 from sys import executable
 from redis import StrictRedis
+from coil.utils import SiteProxy
+import coil.worker
 
+# Seconds a recorded pipeline may wait for its jobs to be enqueued.
+ENQUEUE_GRACE = 60
+_sites = {}
+# Nikola (7) loads and scans sites relative to the working directory, which
+# is shared by all threads of a process, so only scans may change it, one at
+# a time.  Other jobs use absolute paths (and run Nikola with its own cwd).
+_cwd_lock = threading.Lock()
+# Builds, publishes and orphan cleanups of a site must not overlap, even in
+# a worker that runs jobs in threads.
+_site_locks = {}
+_site_locks_lock = threading.Lock()
 
-def build(dburl, sitedir, mode):
-    """Build a site."""
-    if mode == 'force':
-        amode = ['-a']
+
+def _site_lock(sitedir):
+    """Get the lock for jobs that write the output of a site."""
+    sitedir = os.path.abspath(sitedir)
+    with _site_locks_lock:
+        if sitedir not in _site_locks:
+            _site_locks[sitedir] = threading.Lock()
+        return _site_locks[sitedir]
+
+
+class _TimeLimit(object):
+    """Terminate a process when its job times out.
+
+    rq cannot interrupt jobs running in threads (see
+    :class:`coil.worker.ThreadedWorker`), so jobs end their Nikola process
+    themselves.
+    """
+
+    def __init__(self, p, deadline):
+        """Initialize a time limit.
+
+        :param p: The process, a :class:`subprocess.Popen` or compatible
+        :param float deadline: Time (as in :func:`time.time`) to terminate
+                               the process at
+        """
+        self.p = p
+        self.expired = False
+        self.timer = threading.Timer(max(deadline - time.time(), 0),
+                                     self._expire)
+        self.timer.daemon = True
+
+    def __enter__(self):
+        self.timer.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer.cancel()
+
+    def _expire(self):
+        """Terminate the process."""
+        self.expired = True
+        try:
+            self.p.terminate()
+        except OSError:
+            # It has just ended.
+            pass
+
+
+def _deadline(job):
+    """Get the time a job has to end by, from its rq timeout."""
+    return time.time() + (job.timeout or Queue.DEFAULT_TIMEOUT)
+
+
+def _site_proxy(db, sitedir):
+    """Get a proxy for the site in sitedir, loading the site if needed."""
+    if sitedir not in _sites:
+        doit = coil.worker.warm_site(sitedir)
+        if doit is not None:
+            _site = doit.nikola
+        else:
+            nikola.__main__._RETURN_DOITNIKOLA = True
+            _site = nikola.__main__.main([]).nikola
+            _site.init_plugins()
+        logger = nikola.utils.get_logger('CoilScan',
+                                         nikola.utils.STDERR_HANDLER)
+        _sites[sitedir] = SiteProxy(db, _site, logger, scan=False)
+    return _sites[sitedir]
+
+
+def _python():
+    """Get the Python interpreter to run Nikola with."""
+    if executable.endswith('uwsgi'):
+        # hack, might fail in some environments!
+        return executable[:-5] + 'python'
+    return executable
+
+
+def _nikola(sitedir, args, targets=None, **kwargs):
+    """Start a Nikola command, forking from the warm site if there is one.
+
+    :param str sitedir: Path to the site
+    :param list args: Nikola command line, like ``['build']``
+    :param str targets: File to write the targets of all tasks to, see
+                        :func:`coil.targets.record_targets`
+    :return: a :class:`subprocess.Popen` or compatible object
+    """
+    doit = coil.worker.warm_site(sitedir)
+    if doit is not None:
+        return coil.worker.ForkedNikola(doit, args, cwd=sitedir,
+                                        targets=targets, **kwargs)
+    if targets is not None:
+        command = ['-m', 'coil.targets', targets]
     else:
-        amode = []
-    oldcwd = os.getcwd()
-    os.chdir(sitedir)
+        command = ['-m', 'nikola']
+    return subprocess.Popen([_python()] + command + args, cwd=sitedir,
+                            **kwargs)
+
+
+def scan(dburl, sitedir):
+    """Rescan pending paths (or the whole site) in the background.
+
+    Pending paths are moved to ``site:scan:processing`` (and the full scan
+    flag to ``site:scan:full:processing``) until they are applied, so the
+    next scan retries them if this one fails.
+
+    Nikola finds posts relative to the working directory, so scans change it
+    (see ``_cwd_lock``); ``sitedir`` must be absolute.
+    """
+    if not os.path.isabs(sitedir):
+        raise ValueError("The site path must be absolute: " + sitedir)
     db = StrictRedis.from_url(dburl)
-    job = get_current_job(db)
-    job.meta.update({'out': '', 'milestone': 0, 'total': 1, 'return': None,
-                     'status': None})
+
+    def _take(pipe):
+        full = (pipe.exists('site:scan:full') or
+                pipe.exists('site:scan:full:processing'))
+        pipe.multi()
+        # From now on, new changes need a new job.
+        pipe.delete('site:scan:queued')
+        pipe.sunionstore('site:scan:processing', 'site:scan:processing',
+                         'site:scan:pending')
+        pipe.delete('site:scan:pending', 'site:scan:full')
+        if full:
+            pipe.set('site:scan:full:processing', '1')
+        return full
+
+    full = db.transaction(_take, 'site:scan:full',
+                          'site:scan:full:processing',
+                          value_from_callable=True)
+    paths = db.smembers('site:scan:processing')
+    with _cwd_lock:
+        oldcwd = os.getcwd()
+        os.chdir(sitedir)
+        try:
+            site = _site_proxy(db, sitedir)
+            if full:
+                site.scan_posts()
+            elif paths:
+                site.rescan_paths([p.decode('utf-8') for p in paths])
+        finally:
+            os.chdir(oldcwd)
+    pipe = db.pipeline()
+    if paths:
+        pipe.srem('site:scan:processing', *paths)
+    if full:
+        pipe.delete('site:scan:full:processing')
+    pipe.execute()
+
+
+class BuildLog(object):
+    """Output of a build task, stored as one Redis list item per line.
+
+    New lines are also published on the ``site:build:events`` channel.
+    """
+
+    def __init__(self, db, name):
+        """Initialize a log.
+
+        :param db: Redis connection
+        :param str name: Name of the task (``build`` or ``orphans``)
+        """
+        self.db = db
+        self.name = name
+        self.key = 'site:log:{0}'.format(name)
+        self.length = None
+
+    def clear(self):
+        """Remove all lines."""
+        self.db.delete(self.key)
+        self.length = 0
+
+    def extend(self, lines):
+        """Append lines to the log."""
+        if not lines:
+            return
+        lines = [l.rstrip('\n') for l in lines]
+        pipe = self.db.pipeline(transaction=False)
+        pipe.rpush(self.key, *lines)
+        pipe.publish('site:build:events', json.dumps({
+            self.name + '_log': lines, self.name + '_offset': self.length}))
+        pipe.execute()
+        self.length += len(lines)
+
+    def read(self, offset=0):
+        """Read the lines after the first offset ones."""
+        return [l.decode('utf-8') for l in
+                self.db.lrange(self.key, offset, -1)]
+
+
+class MemoryLog(object):
+    """Output of a build task, kept in memory (Limited Mode).
+
+    Only the last ``maxlen`` lines are kept, but offsets count all lines, like
+    in :class:`BuildLog`.
+    """
+
+    def __init__(self, maxlen=10000):
+        """Initialize a log.
+
+        :param int maxlen: Number of lines to keep
+        """
+        self.lines = collections.deque(maxlen=maxlen)
+        self.length = 0
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """Remove all lines."""
+        with self.lock:
+            self.lines.clear()
+            self.length = 0
+
+    def extend(self, lines):
+        """Append lines to the log."""
+        with self.lock:
+            self.lines.extend(l.rstrip('\n') for l in lines)
+            self.length += len(lines)
+
+    def read(self, offset=0):
+        """Read the lines after the first offset ones.
+
+        :return: the offset of the first line returned (higher than
+                 requested if lines were dropped), and the lines
+        :rtype: tuple
+        """
+        with self.lock:
+            first = self.length - len(self.lines)
+            offset = max(offset, first)
+            return offset, list(self.lines)[offset - first:]
+
+
+def _save_meta(db, job, name):
+    """Save job metadata and announce it."""
     job.save()
-    p = subprocess.Popen([executable, '-m', 'nikola', 'build'] + amode,
-                         stderr=subprocess.PIPE)
-
-    milestones = {
-        'done!': 0,
-        'render_posts': 0,
-        'render_pages': 0,
-        'generate_rss': 0,
-        'render_indexes': 0,
-        'sitemap': 0
-    }
-    out = []
+    db.publish('site:build:events', json.dumps({name: job.meta}))
+
+
+class BuildProgress(object):
+    """Track build progress from the tasks doit reports.
+
+    The build runs with doit's console reporter, which prints one line for
+    every task, executed (``.``), up-to-date (``--``) or ignored (``!!``).
+    """
+
+    task_line = re.compile(r'^(?:\.  |-- |!! )(\S.*)$')
+
+    def __init__(self, total, durations):
+        """Initialize progress tracking.
+
+        :param int total: Expected number of tasks
+        :param list durations: Durations of previous builds, in seconds
+        """
+        self.total = total
+        self.done = 0
+        self.task = None
+        self.start = time.time()
+        if durations:
+            self.expected = sum(durations) / len(durations)
+        else:
+            self.expected = None
+
+    def feed(self, line):
+        """Process a line of output.
+
+        :return: whether the line was a task
+        :rtype: bool
+        """
+        m = self.task_line.match(line.rstrip())
+        if not m:
+            return False
+        self.done += 1
+        self.task = m.group(1)
+        return True
+
+    def eta(self):
+        """Estimate the remaining time, in seconds (or None)."""
+        elapsed = time.time() - self.start
+        if self.expected is not None and elapsed < self.expected:
+            return int(self.expected - elapsed)
+        elif self.done and self.total:
+            return int(elapsed * max(self.total - self.done, 0) / self.done)
+        return None
+
+    def meta(self):
+        """Get progress information for job metadata."""
+        total = max(self.total, self.done)
+        return {'done': self.done, 'total': total, 'task': self.task,
+                'eta': self.eta()}
+
+
+class Manifest(object):
+    """The output files of the last complete build.
+
+    These are the targets of all tasks of the site, as absolute paths.  The
+    build writes them to a temporary file (see :mod:`coil.targets`).
+    """
+
+    key = 'site:build:manifest'
+
+    def __init__(self, db):
+        """Initialize a manifest.
+
+        :param db: Redis connection
+        """
+        self.db = db
+        self.files = set()
+        fd, self.path = tempfile.mkstemp(prefix='coil-targets-')
+        os.close(fd)
+
+    def read(self):
+        """Read the targets written by the build, and remove the file.
+
+        :return: whether the build listed its targets
+        :rtype: bool
+        """
+        try:
+            with io.open(self.path, 'r', encoding='utf-8') as fh:
+                self.files = set(l.rstrip('\n') for l in fh if l.strip())
+        finally:
+            os.unlink(self.path)
+        return bool(self.files)
+
+    def save(self, build_id):
+        """Replace the stored manifest.
+
+        :param str build_id: ID of the build job that produced it
+        """
+        new = self.key + ':new'
+        files = sorted(self.files)
+        pipe = self.db.pipeline(transaction=False)
+        pipe.delete(new)
+        for i in range(0, len(files), 10000):
+            pipe.sadd(new, *files[i:i + 10000])
+        pipe.execute()
+        pipe = self.db.pipeline()
+        if files:
+            pipe.rename(new, self.key)
+        else:
+            pipe.delete(self.key)
+        pipe.set(self.key + ':build', build_id)
+        pipe.execute()
+
+    @classmethod
+    def load(cls, db, build_id):
+        """Load the manifest made by a build.
+
+        :return: set of paths, or None if that build did not store one
+        """
+        if db.get(cls.key + ':build') != build_id.encode('utf-8'):
+            return None
+        return set(f.decode('utf-8') for f in db.smembers(cls.key))
+
+
+def find_orphans(sitedir, output_folder, manifest):
+    """List files in the output folder that are not in the manifest.
+
+    :param str sitedir: Path to the site
+    :param str output_folder: Path to the output folder (absolute, or
+                              relative to the site)
+    :param set manifest: Absolute paths of output files
+    :return: absolute paths
+    :rtype: list
+    """
+    found = []
+    output_folder = os.path.abspath(os.path.join(sitedir, output_folder))
+    for root, dirs, files in os.walk(output_folder, followlinks=True):
+        for name in files:
+            path = os.path.join(root, name)
+            if path not in manifest:
+                found.append(path)
+    return found
+
+
+def _count_tasks(sitedir):
+    """Count the tasks of a site (slow, it loads the site)."""
+    p = _nikola(sitedir, ['list', '--all'], stdout=subprocess.PIPE)
+    out = p.communicate()[0]
+    return len([l for l in out.splitlines() if l.strip()])
+
+
+def _task_count(db, sitedir):
+    """Get the number of tasks a build reports."""
+    count = db.get('site:build:tasks')
+    if count is not None:
+        return int(count)
+    return _count_tasks(sitedir)
+
+
+def build_state(db, queue):
+    """Get the state of the build pipeline.
+
+    A pipeline with a failed or lost job (a job that does not exist, eg.
+    after a worker crashed) is idle, since nothing would ever finish it.
+
+    :return: ``idle``, ``queued`` (not building yet, so it will include all
+             changes made until now), ``building`` or ``cleaning``
+    :rtype: str
+    """
+    jobs = db.hgetall('site:build:jobs')
+    state = jobs.get(b'state', b'done').decode('utf-8')
+    if state not in ('queued', 'building', 'cleaning'):
+        return 'idle'
+    # The orphans job ends the pipeline, and waits (deferred) until then.
+    job = queue.fetch_job(jobs[b'orphans'].decode('utf-8'))
+    if job is None:
+        # The jobs are enqueued right after the pipeline is recorded.
+        created = float(jobs.get(b'created', 0))
+        if state == 'queued' and time.time() - created < ENQUEUE_GRACE:
+            return state
+        return 'idle'
+    if job.is_failed:
+        return 'idle'
+    if state != 'cleaning':
+        # The build job expires a while after finishing; only check it
+        # before that.
+        job = queue.fetch_job(jobs[b'build'].decode('utf-8'))
+        if job is not None and job.is_failed:
+            return 'idle'
+    return state
+
 
+def _new_build(pipe, mode, processes):
+    """Record a new build pipeline and return its job IDs.
+
+    Follow-up requests left by the previous pipeline are dropped, since the
+    new build includes them.
+    """
+    build_id = str(uuid.uuid4())
+    orphans_id = str(uuid.uuid4())
+    pipe.delete('site:build:jobs', 'site:build:requested',
+                'site:build:cancel', 'site:build:processes')
+    pipe.hmset('site:build:jobs', {'build': build_id, 'orphans': orphans_id,
+                                   'mode': mode, 'processes': processes,
+                                   'state': 'queued',
+                                   'created': time.time()})
+    return build_id, orphans_id
+
+
+def _enqueue_build(queue, dburl, sitedir, ids, debounce, processes,
+                   cleanup):
+    """Enqueue the jobs of a build pipeline.
+
+    :param tuple cleanup: Output folder and dry run flag, for the orphan
+                          cleanup
+    """
+    build_id, orphans_id = ids
+    build_job = queue.enqueue_call(func=build,
+                                   args=(dburl, sitedir, '', debounce,
+                                         processes),
+                                   job_id=build_id)
+    queue.enqueue_call(func=orphans, args=(dburl, sitedir) + tuple(cleanup),
+                       job_id=orphans_id, depends_on=build_job)
+
+
+def request_build(db, queue, dburl, sitedir, mode='', debounce=0,
+                  start=True, processes=1, output_folder='output',
+                  dry_run=False):
+    """Request a build, coalescing it with the one in progress.
+
+    If the pipeline is idle, a build (followed by an orphan cleanup) is
+    enqueued, unless ``start`` is False.  A queued build includes the new
+    changes anyway.  While building, any number of requests result in exactly
+    one follow-up build, which waits until there were no requests for
+    ``debounce`` seconds.  A forced build cancels the running one.
+
+    :param str mode: ``force`` to rebuild everything, or empty
+    :param float debounce: Seconds without requests before a follow-up build
+    :param bool start: Whether to start a build if none is in progress
+    :param int processes: Number of processes to build with (the highest
+                          requested number is used)
+    :param str output_folder: ``OUTPUT_FOLDER`` of the site
+    :param bool dry_run: Only list orphans, do not remove them
+    :return: whether a build will include the changes made until now
+    :rtype: bool
+    """
+    result = {}
+
+    def _request(pipe):
+        result.clear()
+        state = build_state(pipe, queue)
+        build_id, queued = pipe.hmget('site:build:jobs', 'build', 'processes')
+        requested = pipe.get('site:build:processes')
+        # Left over if the pipeline failed before its follow-up started.
+        pending = pipe.get('site:build:requested')
+        pipe.multi()
+        pipe.set('site:build:last_request', time.time())
+        if state == 'idle':
+            if start or pending is not None:
+                new_mode = 'force' if pending == b'force' else mode
+                new_processes = max(int(requested or 1), processes)
+                result['ids'] = _new_build(pipe, new_mode, new_processes)
+        elif state == 'queued':
+            if mode == 'force':
+                pipe.hset('site:build:jobs', 'mode', mode)
+            pipe.hset('site:build:jobs', 'processes',
+                      max(int(queued or 1), processes))
+        else:
+            pipe.set('site:build:debounce', debounce)
+            pipe.set('site:build:processes',
+                     max(int(requested or 1), processes))
+            if mode == 'force':
+                pipe.set('site:build:requested', 'force')
+                if state == 'building':
+                    pipe.set('site:build:cancel', build_id)
+            else:
+                pipe.set('site:build:requested', 'normal', nx=True)
+        result['requested'] = 'ids' in result or state != 'idle'
+
+    db.transaction(_request, 'site:build:jobs', 'site:build:requested',
+                   'site:build:processes')
+    if 'ids' in result:
+        _enqueue_build(queue, dburl, sitedir, result['ids'], 0, processes,
+                       (output_folder, dry_run))
+    return result['requested']
+
+
+def _set_state(db, job, state):
+    """Set the pipeline state, if the job still belongs to it.
+
+    :return: the pipeline (``site:build:jobs``), or None if the job was
+             superseded
+    """
+    def _set(pipe):
+        jobs = pipe.hgetall('site:build:jobs')
+        if job.id.encode('utf-8') not in (jobs.get(b'build'),
+                                          jobs.get(b'orphans')):
+            return None
+        pipe.multi()
+        pipe.hset('site:build:jobs', 'state', state)
+        return jobs
+
+    return db.transaction(_set, 'site:build:jobs', value_from_callable=True)
+
+
+def _cancelled(db, job):
+    """Check whether the build was cancelled by a forced one."""
+    return db.get('site:build:cancel') == job.id.encode('utf-8')
+
+
+def _debounce(db, debounce):
+    """Wait until there were no build requests for debounce seconds."""
+    while debounce:
+        last = float(db.get('site:build:last_request') or 0)
+        wait = last + debounce - time.time()
+        if wait <= 0:
+            break
+        time.sleep(min(wait, 1))
+
+
+def _build_args(mode, processes):
+    """Get the arguments of ``nikola build`` for a mode and process count."""
+    args = []
+    if mode == 'force':
+        args.append('-a')
+    if processes > 1:
+        args += ['-n', str(processes)]
+    return args
+
+
+def build(dburl, sitedir, mode, debounce=0, processes=1):
+    """Build a site.
+
+    :param str mode: ``force`` to rebuild everything, or empty
+    :param float debounce: Seconds without build requests to wait for first
+    :param int processes: Number of processes to build with
+    """
+    db = StrictRedis.from_url(dburl)
+    job = get_current_job()
+    deadline = _deadline(job)
+    log = BuildLog(db, 'build')
+    _debounce(db, debounce)
+    with _site_lock(sitedir):
+        return _build(db, job, sitedir, log, deadline, mode, processes)
+
+
+def _build(db, job, sitedir, log, deadline, mode, processes):
+    """Build a site (with the site lock held)."""
+    # Requests made from now on need another build.
+    jobs = _set_state(db, job, 'building')
+    if jobs:
+        mode = jobs.get(b'mode', b'').decode('utf-8') or mode
+        processes = int(jobs.get(b'processes', processes))
+    log.clear()
+    durations = [float(d) for d in db.lrange('site:build:durations', 0, -1)]
+    progress = BuildProgress(_task_count(db, sitedir), durations)
+    job.meta.update(progress.meta())
+    job.meta.update({'return': None, 'status': None, 'cancelled': False})
+    _save_meta(db, job, 'build')
+    # doit reports tasks on stdout, Nikola logs to stderr.  With several
+    # processes, each line is still written at once, so lines interleave but
+    # are not mixed up.
+    manifest = Manifest(db)
+    p = _nikola(sitedir, ['build', '--reporter=console'] +
+                _build_args(mode, processes), targets=manifest.path,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def report():
+        job.meta.update(progress.meta())
+        _save_meta(db, job, 'build')
+
+    def cancelled():
+        job.meta['cancelled'] = _cancelled(db, job)
+        return job.meta['cancelled']
+
+    with _TimeLimit(p, deadline) as limit:
+        _follow_build(p, log, progress, report, cancelled)
+    if limit.expired:
+        log.extend(['Terminated: the job timed out.'])
+    job.meta.update(_final_meta(progress, p.returncode))
+    _save_meta(db, job, 'build')
+    # Only a complete build has produced all the files that should exist.
+    if manifest.read() and p.returncode == 0:
+        manifest.save(job.id)
+    if p.returncode == 0:
+        pipe = db.pipeline(transaction=False)
+        pipe.set('site:build:tasks', progress.done)
+        pipe.lpush('site:build:durations', time.time() - progress.start)
+        pipe.ltrim('site:build:durations', 0, 9)
+        pipe.execute()
+    return p.returncode
+
+
+def _follow_build(p, log, progress, report, cancelled=None):
+    """Log the output of a build and track its progress until it ends.
+
+    :param p: The ``nikola build`` process, with output on ``stdout``
+    :param log: :class:`BuildLog` or :class:`MemoryLog`
+    :param BuildProgress progress: Progress of the build
+    :param report: Called (at most twice a second) when there is progress
+    :param cancelled: Called twice a second, terminates the build if it
+                      returns True
+    """
+    saved = 0
+    progressed = False
+    terminated = False
     while p.poll() is None:
-        nl = p.stderr.readline().decode('utf-8')
-        for k in milestones:
-            if k in nl:
-                milestones[k] = 1
-        out.append(nl)
-        job.meta.update({'milestone': sum(milestones.values()), 'total':
-                         len(milestones), 'out': ''.join(out), 'return': None,
-                         'status': None})
-        job.save()
-
-    out += p.stderr.readlines()
-
-    out = ''.join(out)
-    job.meta.update({'milestone': len(milestones), 'total': len(milestones),
-                     'out': ''.join(out), 'return': p.returncode, 'status':
-                     p.returncode == 0})
-    job.save()
-    os.chdir(oldcwd)
+        nl = p.stdout.readline().decode('utf-8')
+        if nl:
+            log.extend([nl])
+        if progress.feed(nl):
+            progressed = True
+        # Checking twice a second is enough for the progress bar.
+        if time.time() - saved > 0.5:
+            if cancelled is not None and not terminated and cancelled():
+                p.terminate()
+                terminated = True
+                log.extend(['Cancelled: superseded by a forced build.'])
+            if progressed:
+                report()
+                progressed = False
+            saved = time.time()
+
+    for nl in p.stdout.readlines():
+        nl = nl.decode('utf-8')
+        log.extend([nl])
+        progress.feed(nl)
+
+
+def _final_meta(progress, returncode):
+    """Get the metadata of a finished build."""
+    meta = progress.meta()
+    meta.update({'done': meta['total'], 'task': None, 'eta': 0,
+                 'return': returncode, 'status': returncode == 0})
+    return meta
+
+
+def _follow_up(db, job, dburl, sitedir):
+    """Finish the pipeline, enqueuing the requested follow-up build if any."""
+    result = {}
+
+    def _finish(pipe):
+        result.clear()
+        if pipe.hget('site:build:jobs', 'orphans') != job.id.encode('utf-8'):
+            return
+        requested = pipe.get('site:build:requested')
+        debounce = float(pipe.get('site:build:debounce') or 0)
+        processes = int(pipe.get('site:build:processes') or 1)
+        pipe.multi()
+        if requested is None:
+            pipe.hset('site:build:jobs', 'state', 'done')
+            return
+        mode = 'force' if requested == b'force' else ''
+        result['ids'] = _new_build(pipe, mode, processes)
+        result['debounce'] = debounce
+        result['processes'] = processes
+
+    db.transaction(_finish, 'site:build:jobs', 'site:build:requested',
+                   'site:build:processes')
+    if 'ids' in result:
+        queue = Queue(job.origin, connection=job.connection)
+        _enqueue_build(queue, dburl, sitedir, result['ids'],
+                       result['debounce'], result['processes'], job.args[2:])
+
+
+def publish(dburl, sitedir, targets):
+    """Build only some targets of a site (the ones that depend on a post).
+
+    :param list targets: Output files and task names, see
+                         :func:`coil.utils.build_targets`
+    """
+    db = StrictRedis.from_url(dburl)
+    job = get_current_job()
+    deadline = _deadline(job)
+    log = BuildLog(db, 'publish')
+    log.clear()
+    job.meta.update({'targets': targets, 'return': None, 'status': None})
+    _save_meta(db, job, 'publish')
+    with _site_lock(sitedir):
+        p = _nikola(sitedir, ['build'] + targets, stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT)
+        with _TimeLimit(p, deadline) as limit:
+            for nl in iter(p.stdout.readline, b''):
+                log.extend([nl.decode('utf-8')])
+            p.wait()
+    if limit.expired:
+        log.extend(['Terminated: the job timed out.'])
+    job.meta.update({'return': p.returncode, 'status': p.returncode == 0})
+    _save_meta(db, job, 'publish')
     return p.returncode
 
 
-def orphans(dburl, sitedir):
-    """Remove all orphans in the site."""
-    oldcwd = os.getcwd()
-    os.chdir(sitedir)
+def orphans(dburl, sitedir, output_folder='output', dry_run=False):
+    """Remove all orphans in the site.
+
+    :param str output_folder: ``OUTPUT_FOLDER`` of the site
+    :param bool dry_run: Only list orphans, do not remove them
+    """
     db = StrictRedis.from_url(dburl)
-    job = get_current_job(db)
-    job.meta.update({'out': '', 'return': None, 'status': None})
-    job.save()
-    returncode, out = orphans_single(default_exec=True)
+    job = get_current_job()
+    deadline = _deadline(job)
+    with _site_lock(sitedir):
+        return _orphans(db, job, dburl, sitedir, deadline, output_folder,
+                        dry_run)
 
-    job.meta.update({'out': out, 'return': returncode, 'status':
-                     returncode == 0})
-    job.save()
-    os.chdir(oldcwd)
+
+def _orphans(db, job, dburl, sitedir, deadline, output_folder, dry_run):
+    """Remove all orphans in the site (with the site lock held)."""
+    log = BuildLog(db, 'orphans')
+    log.clear()
+    _set_state(db, job, 'cleaning')
+    job.meta.update({'return': None, 'status': None, 'dry_run': dry_run})
+    _save_meta(db, job, 'orphans')
+    build_job = job.dependency
+    manifest = None
+    if build_job is not None:
+        manifest = Manifest.load(db, build_job.id)
+    if build_job is not None and build_job.meta.get('cancelled'):
+        # The output is incomplete, and the next build will clean up.
+        returncode = 0
+        log.extend(['Skipped: the build was cancelled.'])
+    elif manifest is not None:
+        files = find_orphans(sitedir, output_folder, manifest)
+        if dry_run:
+            log.extend(['Dry run: these files would be removed.'])
+        else:
+            for f in files:
+                os.unlink(f)
+        files = [os.path.relpath(f, sitedir) for f in files]
+        for i in range(0, len(files), 1000):
+            log.extend(files[i:i + 1000])
+        returncode = 0
+    else:
+        # No manifest (the build failed), let Nikola find the orphans.
+        p = _nikola(sitedir, ['orphans'], stdout=subprocess.PIPE)
+        with _TimeLimit(p, deadline) as limit:
+            returncode, out = _remove_orphans(p, sitedir, dry_run)
+        if limit.expired:
+            out += '\nTerminated: the job timed out.'
+        if dry_run:
+            log.extend(['Dry run: these files would be removed.'])
+        log.extend(out.splitlines())
+
+    # Announce the follow-up (if any) before this pipeline is seen as done.
+    _follow_up(db, job, dburl, sitedir)
+    job.meta.update({'return': returncode, 'status': returncode == 0})
+    _save_meta(db, job, 'orphans')
     return returncode
 
 
-def build_single(mode):
-    """Build, in the single-user mode."""
-    if mode == 'force':
-        amode = ['-a']
-    else:
-        amode = []
-    if executable.endswith('uwsgi'):
-        # hack, might fail in some environments!
-        _executable = executable[:-5] + 'python'
-    else:
-        _executable = executable
-    p = subprocess.Popen([_executable, '-m', 'nikola', 'build'] + amode,
-                         stderr=subprocess.PIPE)
-    p.wait()
-    rl = p.stderr.readlines()
-    try:
-        out = ''.join(rl)
-    except TypeError:
-        out = ''.join(l.decode('utf-8') for l in rl)
-    return (p.returncode == 0), out
-
-
-def orphans_single(default_exec=False):
-    """Remove all orphans in the site, in the single user-mode."""
-    if not default_exec and executable.endswith('uwsgi'):
-        # default_exec => rq => sys.executable is sane
-        _executable = executable[:-5] + 'python'
-    else:
-        _executable = executable
-    p = subprocess.Popen([_executable, '-m', 'nikola', 'orphans'],
-                         stdout=subprocess.PIPE)
-    p.wait()
+class LocalBuild(object):
+    """Builds and orphan cleanups in a background thread (Limited Mode).
+
+    Publishes run in threads of their own, one site job at a time.
+    Metadata and logs have the same shape as in Full Mode, but are kept in
+    memory.  Requests made while building result in one follow-up build.
+    """
+
+    def __init__(self, sitedir, output_folder='output', dry_run=False,
+                 debounce=0, maxlen=10000):
+        """Initialize local builds.
+
+        :param str sitedir: Path to the site
+        :param str output_folder: ``OUTPUT_FOLDER`` of the site
+        :param bool dry_run: Only list orphans, do not remove them
+        :param float debounce: Seconds without requests before a follow-up
+        :param int maxlen: Number of log lines to keep
+        """
+        self.sitedir = sitedir
+        self.output_folder = output_folder
+        self.dry_run = dry_run
+        self.debounce = debounce
+        self.logs = {'build': MemoryLog(maxlen), 'orphans': MemoryLog(maxlen),
+                     'publish': MemoryLog(maxlen)}
+        self.meta = {'build': {}, 'orphans': {}, 'publish': {}}
+        self.pipeline = None
+        self.tasks = None
+        self.durations = collections.deque(maxlen=10)
+        self.running = False
+        self.requested = None
+        self.last_request = 0
+        self.lock = threading.Lock()
+
+    def request(self, mode='', processes=1, start=True):
+        """Request a build, coalescing it with the one in progress.
+
+        :param str mode: ``force`` to rebuild everything, or empty
+        :param int processes: Number of processes to build with
+        :param bool start: Whether to start a build if none is in progress
+        :return: whether a build will include the changes made until now
+        :rtype: bool
+        """
+        with self.lock:
+            self.last_request = time.time()
+            if self.running:
+                requested = self.requested or {'mode': '', 'processes': 1}
+                if mode == 'force':
+                    requested['mode'] = mode
+                requested['processes'] = max(requested['processes'],
+                                             processes)
+                self.requested = requested
+                return True
+            if not start:
+                return False
+            self.running = True
+            self._reset()
+        thread = threading.Thread(target=self._run, args=(mode, processes))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def publish(self, targets):
+        """Build only some targets of the site, in a background thread.
+
+        :param list targets: Output files and task names, see
+                             :func:`coil.utils.build_targets`
+        """
+        # Like a queued job: no metadata until it starts.
+        self.meta['publish'] = {}
+        thread = threading.Thread(target=self._publish, args=(targets,))
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def idle(self):
+        """Whether no build is running or requested."""
+        return not self.running
+
+    def state(self, build_offset=0, orphans_offset=0):
+        """Get metadata and new log lines, like the rebuild API."""
+        with self.lock:
+            build_offset, build_log = self.logs['build'].read(build_offset)
+            orphans_offset, orphans_log = self.logs['orphans'].read(
+                orphans_offset)
+            return {
+                'pipeline': self.pipeline,
+                'build': self.meta['build'],
+                'orphans': self.meta['orphans'],
+                'build_log': build_log,
+                'build_offset': build_offset,
+                'orphans_log': orphans_log,
+                'orphans_offset': orphans_offset,
+            }
+
+    def _reset(self):
+        """Start a new pipeline."""
+        self.pipeline = str(uuid.uuid4())
+        self.meta.update({'build': {}, 'orphans': {}})
+        self.logs['build'].clear()
+        self.logs['orphans'].clear()
+
+    def _run(self, mode, processes):
+        """Run builds until there are no more requests."""
+        while True:
+            try:
+                with _site_lock(self.sitedir):
+                    self._orphans(self._build(mode, processes))
+            except Exception:
+                self.logs['build'].extend(
+                    traceback.format_exc().splitlines())
+                self.meta['build'] = dict(self.meta['build'], status=False)
+                self.meta['orphans'] = dict(self.meta['orphans'],
+                                            status=False)
+            while True:
+                wait = self.last_request + self.debounce - time.time()
+                if self.requested is None or wait <= 0:
+                    break
+                time.sleep(min(wait, 1))
+            with self.lock:
+                if self.requested is None:
+                    self.running = False
+                    return
+                mode = self.requested['mode']
+                processes = self.requested['processes']
+                self.requested = None
+                self._reset()
+
+    def _build(self, mode, processes):
+        """Build the site.
+
+        :return: the manifest, or None if the build failed
+        """
+        if self.tasks is None:
+            self.tasks = _count_tasks(self.sitedir)
+        progress = BuildProgress(self.tasks, list(self.durations))
+        meta = progress.meta()
+        meta.update({'return': None, 'status': None})
+        self.meta['build'] = meta
+        manifest = Manifest(None)
+        p = _nikola(self.sitedir, ['build', '--reporter=console'] +
+                    _build_args(mode, processes), targets=manifest.path,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+        def report():
+            self.meta['build'] = dict(self.meta['build'], **progress.meta())
+
+        _follow_build(p, self.logs['build'], progress, report)
+        self.meta['build'] = _final_meta(progress, p.returncode)
+        listed = manifest.read()
+        if p.returncode != 0:
+            return None
+        self.tasks = progress.done
+        self.durations.appendleft(time.time() - progress.start)
+        return manifest.files if listed else None
+
+    def _orphans(self, manifest):
+        """Remove orphans, using the manifest of the build if possible."""
+        log = self.logs['orphans']
+        self.meta['orphans'] = {'return': None, 'status': None,
+                                'dry_run': self.dry_run}
+        if self.dry_run:
+            log.extend(['Dry run: these files would be removed.'])
+        if manifest is not None:
+            files = find_orphans(self.sitedir, self.output_folder, manifest)
+            if not self.dry_run:
+                for f in files:
+                    os.unlink(f)
+            log.extend([os.path.relpath(f, self.sitedir) for f in files])
+            returncode = 0
+        else:
+            p = subprocess.Popen([_python(), '-m', 'nikola', 'orphans'],
+                                 cwd=self.sitedir, stdout=subprocess.PIPE)
+            returncode, out = _remove_orphans(p, self.sitedir, self.dry_run)
+            log.extend(out.splitlines())
+        self.meta['orphans'] = {'return': returncode,
+                                'status': returncode == 0,
+                                'dry_run': self.dry_run}
+
+    def _publish(self, targets):
+        """Build some targets, like :func:`publish` (runs in a thread)."""
+        log = self.logs['publish']
+        with _site_lock(self.sitedir):
+            log.clear()
+            self.meta['publish'] = {'targets': targets, 'return': None,
+                                    'status': None}
+            try:
+                p = _nikola(self.sitedir, ['build'] + targets,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+                for nl in iter(p.stdout.readline, b''):
+                    log.extend([nl.decode('utf-8')])
+                returncode = p.wait()
+            except Exception:
+                log.extend(traceback.format_exc().splitlines())
+                returncode = None
+            self.meta['publish'] = {'targets': targets, 'return': returncode,
+                                    'status': returncode == 0}
+
+
+def _remove_orphans(p, sitedir, dry_run=False):
+    """Remove the orphans listed by a ``nikola orphans`` process."""
     files = [l.strip().decode('utf-8') for l in p.stdout.readlines()]
+    p.wait()
+    # A terminated process may have listed only part of a path.
     for f in files:
-        if f:
-            os.unlink(f)
+        if f and not dry_run and p.returncode == 0:
+            os.unlink(os.path.join(sitedir, f))
 
     out = '\n'.join(files)
     return p.returncode, out
@@ -27,13 +27,26 @@
 
 from __future__ import unicode_literals
 from nikola.post import Post
+from nikola.utils import get_translation_candidate
+import calendar
+import collections
+import dateutil.parser
+import fnmatch
+import math
+import os
+import socket
 import sys
 import json
+import threading
 import time
+import uuid
 
 
-__all__ = ['PERMISSIONS', 'USER_FIELDS', 'USER_ALL', 'ask', 'ask_yesno',
-           'SiteProxy']
+__all__ = ['PERMISSIONS', 'USER_FIELDS', 'USER_ALL', 'allocate_uid', 'ask',
+           'ask_yesno', 'Subscriber', 'SiteLock', 'SiteLockLost', 'SiteProxy',
+           'UserCache', 'base_path', 'build_targets', 'build_user_index',
+           'decode_user', 'index_user', 'load_post', 'load_users',
+           'search_users']
 
 USER_FIELDS = ['username', 'realname', 'password', 'email']
 # internal order
@@ -90,125 +103,1061 @@ def ask_yesno(query, default=None):
         return ask_yesno(query, default)
 
 
+class Subscriber(object):
+    """Listen to a Redis pub/sub channel in a background thread.
+
+    The thread is started lazily and restarted after a fork, so that each
+    worker process gets its own connection.  ``connected`` is False until
+    the subscription is confirmed and after the connection is lost; callers
+    should fall back to polling in that case.
+    """
+
+    def __init__(self, db, channel, callback, logger, on_connect=None):
+        """Initialize a subscriber.
+
+        :param db: Redis connection
+        :param str channel: Channel to subscribe to
+        :param callback: Function called with the data of every message
+        :param logger: Logger to report problems to
+        :param on_connect: Function called once the subscription is active
+        """
+        self.db = db
+        self.channel = channel
+        self.callback = callback
+        self.logger = logger
+        self.on_connect = on_connect
+        self.connected = False
+        self._pid = None
+
+    def start(self):
+        """Start listening, unless this process is already listening."""
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self.connected = False
+        thread = threading.Thread(target=self._listen,
+                                  name='coil-{0}'.format(self.channel))
+        thread.daemon = True
+        thread.start()
+
+    def _listen(self):
+        """Listen to the channel (runs in a thread)."""
+        pid = os.getpid()
+        try:
+            pubsub = self.db.pubsub()
+            pubsub.subscribe(self.channel)
+            for message in pubsub.listen():
+                if message['type'] == 'subscribe':
+                    self.connected = True
+                    if self.on_connect is not None:
+                        # Catch up with anything sent before subscribing.
+                        self.on_connect()
+                elif message['type'] == 'message':
+                    self.callback(message['data'])
+        except Exception as e:
+            self.logger.warn("Lost subscription to {0}: {1}".format(
+                self.channel, e))
+        finally:
+            self.connected = False
+            if self._pid == pid:
+                # Let the next start() call retry.
+                self._pid = None
+
+
+class SiteLockLost(Exception):
+    """The site lock expired, or another worker wrote to the site."""
+
+
+class SiteLock(object):
+    """An expiring lock on the site database.
+
+    The lock holds a token identifying its owner and expires after
+    ``timeout`` seconds, so a crashed worker cannot keep it forever.  The
+    token is kept per thread, so threads sharing the lock object do not
+    release each other's locks.  Waiters block on a list that is pushed to on
+    release instead of sleeping.  Wait times are logged and counted in the
+    ``site:lock:stats`` hash.
+
+    A lock without an expiry was left by an older Coil (which counted
+    holders with INCR/DECR); ``0`` is removed, anything else gets an expiry.
+    """
+
+    _release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('del', KEYS[1], KEYS[2])
+    redis.call('rpush', KEYS[2], '1')
+    redis.call('pexpire', KEYS[2], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+    # Get the milliseconds left on the lock, cleaning up legacy locks.
+    _ttl_script = """
+local ttl = redis.call('pttl', KEYS[1])
+if ttl == -1 then
+    if redis.call('get', KEYS[1]) == '0' then
+        redis.call('del', KEYS[1])
+        return 0
+    end
+    redis.call('pexpire', KEYS[1], ARGV[1])
+    return tonumber(ARGV[1])
+end
+return ttl
+"""
+
+    def __init__(self, db, logger, name='site:lock', timeout=120):
+        """Initialize a lock.
+
+        :param db: Redis connection
+        :param logger: Logger to report to
+        :param str name: Key of the lock
+        :param int timeout: Seconds after which the lock expires
+        """
+        self.db = db
+        self.logger = logger
+        self.name = name
+        self.signal = name + ':signal'
+        self.timeout = timeout
+        self.identity = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self._local = threading.local()
+        self._release = db.register_script(self._release_script)
+        self._ttl = db.register_script(self._ttl_script)
+
+    @property
+    def token(self):
+        """Get the token of the lock held by this thread, or None."""
+        return getattr(self._local, 'token', None)
+
+    def holds(self, pipe):
+        """Check if this thread still holds the lock.
+
+        :param pipe: Redis connection, or pipeline in WATCH mode
+        :rtype: bool
+        """
+        token = self.token
+        return token is not None and pipe.get(self.name) == token.encode(
+            'utf-8')
+
+    def holder(self):
+        """Get the identity of the current holder, or None."""
+        token = self.db.get(self.name)
+        if token is None:
+            return None
+        return token.decode('utf-8').rsplit(':', 1)[0]
+
+    def acquire(self):
+        """Acquire the lock, waiting for it if needed."""
+        token = '{0}:{1}'.format(self.identity, uuid.uuid4().hex)
+        start = time.time()
+        contended = False
+        while not self.db.set(self.name, token, nx=True,
+                              px=int(self.timeout * 1000)):
+            if not contended:
+                self.logger.info("Waiting for DB lock held by {0}...".format(
+                    self.holder()))
+                contended = True
+            # Wake up on release, or when the lock would have expired.
+            ttl = self._ttl(keys=[self.name],
+                            args=[int(self.timeout * 1000)])
+            if ttl <= 0:
+                # Released (or a legacy lock was removed) meanwhile.
+                continue
+            wait = max(1, int(math.ceil(ttl / 1000.0)))
+            self.db.blpop(self.signal, wait)
+        self._local.token = token
+        waited = time.time() - start
+
+        pipe = self.db.pipeline(transaction=False)
+        pipe.hincrby('site:lock:stats', 'acquired', 1)
+        if contended:
+            pipe.hincrby('site:lock:stats', 'contended', 1)
+            pipe.hincrby('site:lock:stats', 'wait_ms', int(waited * 1000))
+        pipe.execute()
+        self.logger.info("Lock acquired by {0} (waited {1:.3f} s).".format(
+            self.identity, waited))
+
+    def release(self):
+        """Release the lock and wake up a waiter."""
+        if not self._release(keys=[self.name, self.signal],
+                             args=[self.token, int(self.timeout * 1000)]):
+            self.logger.warn("Lock expired before it was released; "
+                             "consider increasing COIL_LOCK_TIMEOUT.")
+        self._local.token = None
+        self.logger.info("Lock released.")
+
+    def __enter__(self):
+        """Acquire the lock."""
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Release the lock."""
+        self.release()
+
+
+def decode_user(data):
+    """Decode a user hash read from Redis.
+
+    :param dict data: ``user:uid`` hash, as returned by ``hgetall``
+    :return: fields as text and permissions as booleans
+    :rtype: dict
+    """
+    record = {}
+    for k, v in data.items():
+        if isinstance(k, bytes):
+            k = k.decode('utf-8')
+        if isinstance(v, bytes):
+            v = v.decode('utf-8')
+        record[k] = v
+    for p in PERMISSIONS:
+        record[p] = record.get(p) == '1'
+    return record
+
+
+def load_users(db, uids):
+    """Load many users in one round trip.
+
+    :param db: Redis connection
+    :param uids: UIDs of the users
+    :return: decoded records by UID (users that do not exist are left out)
+    :rtype: dict
+    """
+    uids = [int(uid) for uid in uids]
+    pipe = db.pipeline(transaction=False)
+    for uid in uids:
+        pipe.hgetall('user:{0}'.format(uid))
+    return dict((uid, decode_user(data))
+                for uid, data in zip(uids, pipe.execute()) if data)
+
+
+# Reserve a username and allocate a UID for it.  UIDs taken by users created
+# without the counter are skipped.
+_ALLOCATE_UID = """
+if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+local uid
+repeat
+    uid = redis.call('INCR', KEYS[2])
+until redis.call('EXISTS', 'user:' .. uid) == 0
+redis.call('HSET', KEYS[1], ARGV[1], uid)
+return uid
+"""
+
+
+def allocate_uid(db, username):
+    """Allocate a UID for a new user, reserving the username.
+
+    :param db: Redis connection
+    :param str username: Username of the new user
+    :return: the new UID, or None if the username is taken
+    :rtype: int
+    """
+    uid = db.register_script(_ALLOCATE_UID)(keys=['users', 'last_uid'],
+                                            args=[username])
+    return int(uid) or None
+
+
+def _user_index_entry(name, uid):
+    """Get the entry of a user in a ``users:by_*`` index."""
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    return (name or '').lower().encode('utf-8') + b'\x00' + str(
+        uid).encode('ascii')
+
+
+def index_user(pipe, uid, old, new):
+    """Update the user indexes for a user that was written.
+
+    :param pipe: Redis pipeline
+    :param int uid: UID of the user
+    :param dict old: Previous (decoded) record of the user, or None
+    :param dict new: New (decoded) record of the user
+    """
+    for field in ('username', 'realname'):
+        key = 'users:by_{0}'.format(field)
+        if old and old.get(field) is not None and old[field] != new[field]:
+            pipe.zrem(key, _user_index_entry(old[field], uid))
+        pipe.zadd(key, 0, _user_index_entry(new[field], uid))
+    if new['active']:
+        pipe.sadd('users:active', uid)
+    else:
+        pipe.srem('users:active', uid)
+
+
+def build_user_index(db):
+    """Build the user indexes, unless they exist already.
+
+    :param db: Redis connection
+    """
+    if db.exists('users:indexed'):
+        return
+    records = load_users(db, db.hvals('users'))
+    pipe = db.pipeline()
+    pipe.delete('users:active', 'users:by_username', 'users:by_realname')
+    for uid, record in records.items():
+        index_user(pipe, uid, None, record)
+    pipe.set('users:indexed', '1')
+    pipe.execute()
+
+
+def search_users(db, prefix='', field='username', start=0, count=50,
+                 active=False):
+    """Find users by the start of their username or real name.
+
+    :param db: Redis connection
+    :param str prefix: Start of the name (case-insensitive)
+    :param str field: ``username`` or ``realname`` (also the sort order)
+    :param int start: Position in the index to start at
+    :param int count: Maximum number of users to return
+    :param bool active: Only return active users
+    :return: UIDs, and the position of the next page (None if this is the
+             last one)
+    :rtype: tuple
+    """
+    key = 'users:by_{0}'.format(field)
+    if prefix:
+        prefix = prefix.lower().encode('utf-8')
+        # No UTF-8 sequence contains \xff.
+        low, high = b'[' + prefix, b'[' + prefix + b'\xff'
+    else:
+        low, high = '-', '+'
+    # Look for one more user, to know if there is a next page.
+    found = []
+    while len(found) <= count:
+        entries = db.zrangebylex(key, low, high, start, count + 1)
+        uids = [int(e.rsplit(b'\x00', 1)[1]) for e in entries]
+        if active and uids:
+            pipe = db.pipeline(transaction=False)
+            for uid in uids:
+                pipe.sismember('users:active', uid)
+            wanted = pipe.execute()
+        else:
+            wanted = [True] * len(uids)
+        found.extend((uid, start + i) for i, (uid, ok) in
+                     enumerate(zip(uids, wanted)) if ok)
+        start += len(entries)
+        if len(entries) <= count:
+            break
+    if len(found) > count:
+        return [uid for uid, _ in found[:count]], found[count][1]
+    return [uid for uid, _ in found], None
+
+
+class UserCache(object):
+    """Cache of user records, shared by the threads of a worker.
+
+    Writers announce changed UIDs on the ``users:changed`` channel, and every
+    worker drops its copy.  Records are only cached while subscribed, so
+    a worker that lost its subscription reads Redis every time.
+    """
+
+    def __init__(self, db, logger):
+        """Initialize a cache.
+
+        :param db: Redis connection
+        :param logger: Logger to report problems to
+        """
+        self.db = db
+        self._users = {}
+        self._uids = {}
+        self._lock = threading.Lock()
+        # Incremented on every change, so that records read before a change
+        # are not cached after it.
+        self._generation = 0
+        self._subscriber = Subscriber(db, 'users:changed', self._changed,
+                                      logger, self.clear)
+
+    def clear(self):
+        """Forget all records."""
+        with self._lock:
+            self._generation += 1
+            self._users.clear()
+            self._uids.clear()
+
+    def _changed(self, uid):
+        """Forget a record announced as changed."""
+        uid = int(uid)
+        with self._lock:
+            self._generation += 1
+            self._users.pop(uid, None)
+            for name in [n for n, u in self._uids.items() if u == uid]:
+                del self._uids[name]
+
+    def get(self, uid):
+        """Get the record of a user.
+
+        :param int uid: UID of the user
+        :return: decoded record (a copy), or None if the user does not exist
+        :rtype: dict
+        """
+        uid = int(uid)
+        self._subscriber.start()
+        with self._lock:
+            record = self._users.get(uid)
+            generation = self._generation
+        if record is None:
+            data = self.db.hgetall('user:{0}'.format(uid))
+            if not data:
+                return None
+            record = decode_user(data)
+            with self._lock:
+                if (self._subscriber.connected and
+                        generation == self._generation):
+                    self._users[uid] = record
+        return dict(record)
+
+    def get_many(self, uids):
+        """Get the records of many users, loading missing ones at once.
+
+        :param uids: UIDs of the users
+        :return: decoded records (copies) by UID
+        :rtype: dict
+        """
+        self._subscriber.start()
+        records = {}
+        missing = []
+        with self._lock:
+            for uid in uids:
+                uid = int(uid)
+                record = self._users.get(uid)
+                if record is None:
+                    missing.append(uid)
+                else:
+                    records[uid] = record
+            generation = self._generation
+        if missing:
+            loaded = load_users(self.db, missing)
+            with self._lock:
+                if (self._subscriber.connected and
+                        generation == self._generation):
+                    self._users.update(loaded)
+            records.update(loaded)
+        return dict((uid, dict(record)) for uid, record in records.items())
+
+    def uid(self, username):
+        """Get the UID of a username.
+
+        :param str username: Username to find
+        :return: UID, or None if there is no such user
+        :rtype: int
+        """
+        self._subscriber.start()
+        with self._lock:
+            uid = self._uids.get(username)
+            generation = self._generation
+        if uid is None:
+            uid = self.db.hget('users', username)
+            if uid is None:
+                return None
+            uid = int(uid)
+            with self._lock:
+                if (self._subscriber.connected and
+                        generation == self._generation):
+                    self._uids[username] = uid
+        return uid
+
+    @staticmethod
+    def announce(db, uid):
+        """Announce that a user changed.
+
+        :param db: Redis connection or pipeline
+        :param int uid: UID of the user
+        """
+        db.publish('users:changed', uid)
+
+
+def _timestamp(date):
+    """Convert a datetime into a POSIX timestamp."""
+    return calendar.timegm(date.utctimetuple())
+
+
+def _mtime(post):
+    """Get the last modification time of the files a post is made of."""
+    paths = [post.source_path]
+    if post.is_two_file:
+        paths.append(post.metadata_path)
+    mtime = 0
+    for path in paths:
+        try:
+            mtime = max(mtime, os.path.getmtime(path))
+        except OSError:
+            pass
+    return mtime
+
+
+def _post_entry(post):
+    """Get the data needed to initialize, classify and list a post."""
+    return [post.source_path, post.folder, post.is_post,
+            post._template_name, post.compiler.name, post.use_in_feeds,
+            _timestamp(post.date), _mtime(post), post.title(),
+            post.date.isoformat(), post.meta('author'),
+            post.meta('author.uid')]
+
+
+def base_path(site, source_path):
+    """Get the source path of the post a (possibly translated) file belongs to.
+
+    :param site: Nikola site
+    :param str source_path: Path to a post file or its translation
+    :rtype: str
+    """
+    path = get_translation_candidate(site.config, source_path,
+                                     site.config['DEFAULT_LANG'])
+    if path != source_path and os.path.exists(path):
+        return path
+    return source_path
+
+
+def load_post(site, source_path):
+    """Initialize the post stored in a source path, like a scan would.
+
+    :param site: Nikola site
+    :param str source_path: Path to the post
+    :return: the post, or None if the path is not in ``POSTS`` or ``PAGES``
+    :rtype: Post or None
+    """
+    if any(x.startswith('.') for x in source_path.split(os.sep)):
+        return None
+    for wildcard, destination, template_name, use_in_feeds in \
+            site.config['post_pages']:
+        dirname = os.path.dirname(wildcard)
+        rel = os.path.relpath(os.path.dirname(source_path), dirname)
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            continue
+        if not fnmatch.fnmatch(os.path.basename(source_path),
+                               os.path.basename(wildcard)):
+            continue
+        folder = os.path.normpath(os.path.join(destination, rel))
+        return Post(source_path, site.config, folder, use_in_feeds,
+                    site.MESSAGES, template_name,
+                    site.get_compiler(source_path))
+    return None
+
+
+def build_targets(site, post):
+    """Get the build targets that depend on a post.
+
+    Those are the pages of the post and its translations, and for posts that
+    appear in feeds, the first index page, the RSS feed, tag and category
+    pages, plus the sitemap task.
+
+    :param site: Nikola site
+    :param post: The post (or a handle to it)
+    :return: doit targets (output files and task names)
+    :rtype: list
+    """
+    output = site.config['OUTPUT_FOLDER']
+    paths = []
+    targets = []
+    for lang in site.config['TRANSLATIONS']:
+        if (lang != site.config['DEFAULT_LANG'] and
+                not post.is_translation_available(lang)):
+            continue
+        paths.append(post.destination_path(lang))
+        if not (post.is_post and post.use_in_feeds):
+            continue
+        kinds = [('index', None), ('rss', None)]
+        if hasattr(post, 'tags_for_language'):
+            tags = post.tags_for_language(lang)
+        else:
+            tags = post.tags
+        for tag in tags:
+            kinds += [('tag', tag), ('tag_rss', tag)]
+        if post.meta('category'):
+            kinds.append(('category', post.meta('category')))
+        for kind, name in kinds:
+            path = site.path(kind, name, lang)
+            # Nikola returns an empty path for unknown kinds (plugin disabled)
+            if path and path != '#':
+                paths.append(path)
+    for path in paths:
+        target = os.path.join(output, path)
+        if target not in targets:
+            targets.append(target)
+    targets.append('sitemap')
+    return targets
+
+
+def _author_key(uid, is_post):
+    """Get the name of the per-author index of posts or pages."""
+    return 'site:author:{0}:{1}'.format(uid or 'none',
+                                        'posts' if is_post else 'pages')
+
+
+# Attributes filled by Nikola's scan_posts() that keep posts alive.
+_SCAN_RESULTS = ['timeline', 'posts', 'all_posts', 'pages', 'posts_per_year',
+                 'posts_per_month', 'posts_per_tag', 'posts_per_category',
+                 'post_per_file']
+
+
+class _HandleMeta(object):
+    """Metadata of a :class:`PostHandle`.
+
+    Like Nikola's ``Functionary``, it can be called (``meta(key, lang)``) or
+    indexed by language (``meta[lang]``).
+    """
+
+    def __init__(self, handle):
+        """Initialize metadata for a handle."""
+        self._handle = handle
+
+    def __call__(self, key=None, lang=None):
+        """Get post metadata."""
+        if lang is None and key == 'author':
+            return self._handle._entry[10]
+        elif lang is None and key == 'author.uid':
+            return self._handle._entry[11]
+        return self._handle.post.meta(key, lang)
+
+    def __getitem__(self, lang):
+        """Get all metadata in a language."""
+        return self._handle.post.meta[lang]
+
+
+class PostHandle(object):
+    """A lightweight stand-in for a Post.
+
+    Listing data (title, date, author) comes from the database entry; the
+    full Post is materialized by the proxy when anything else is accessed.
+    """
+
+    def __init__(self, proxy, entry):
+        """Initialize a handle from a database entry."""
+        self._proxy = proxy
+        self._entry = entry
+        self._post = None
+        self._date = None
+        self.source_path = entry[0]
+        self.folder = entry[1]
+        self.is_post = entry[2]
+        self.use_in_feeds = entry[5]
+        self.meta = _HandleMeta(self)
+
+    @property
+    def post(self):
+        """Get the full Post, materializing it if needed."""
+        post = self._post
+        if post is None:
+            post = self._proxy._materialize(self)
+        return post
+
+    @property
+    def date(self):
+        """Get the post date."""
+        if self._date is None:
+            self._date = dateutil.parser.parse(self._entry[9])
+        return self._date
+
+    def title(self, lang=None):
+        """Get the post title."""
+        if lang is None:
+            return self._entry[8]
+        return self.post.title(lang)
+
+    def __getattr__(self, name):
+        """Get any other attribute from the full Post."""
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.post, name)
+
+    def __repr__(self):
+        """Return a programmer-friendly representation."""
+        return '<PostHandle {0}>'.format(self.source_path)
+
+
 class SiteProxy(object):
-    """A proxy for accessing the site in a multiprocessing-safe manner."""
+    """A proxy for accessing the site in a multiprocessing-safe manner.
+
+    Every scan stores the list of changed source paths as a change log entry
+    for the new revision.  Workers that are behind replay those entries and
+    only rebuild the posts that changed.  A full reload happens only if the
+    log does not cover the revisions the worker missed.
+
+    New revisions are announced on the ``site:rev`` channel.  While subscribed
+    to it, the revision is only polled every
+    ``COIL_REVISION_PUBSUB_MAX_AGE`` seconds, in case the subscription died
+    silently (eg. a dropped connection without a reset); otherwise, it is
+    polled at most every ``COIL_REVISION_MAX_AGE`` seconds.
 
-    def __init__(self, db, site, logger):
-        """Initialize a proxy."""
+    Posts are represented by :class:`PostHandle` objects.  At most
+    ``COIL_POST_CACHE_SIZE`` of them keep their full Post in memory.
+    """
+
+    def __init__(self, db, site, logger, scan=True):
+        """Initialize a proxy.
+
+        :param db: Redis connection
+        :param site: Nikola site
+        :param logger: Logger to report to
+        :param bool scan: Scan the site (otherwise, load it from the database)
+        """
         self.db = db
         self._site = site
         self.config = site.config
         self.messages = site.MESSAGES
         self.logger = logger
+        self.changelog_size = self.config.get('COIL_CHANGELOG_SIZE', 100)
+        self.max_age = self.config.get('COIL_REVISION_MAX_AGE', 0)
+        self.pubsub_max_age = max(self.max_age, self.config.get(
+            'COIL_REVISION_PUBSUB_MAX_AGE', 60))
+        self.cache_size = self.config.get('COIL_POST_CACHE_SIZE', 100)
+        self.lock = SiteLock(db, logger,
+                             timeout=self.config.get('COIL_LOCK_TIMEOUT', 120))
 
         self.revision = ''
+        self._known_revision = None
+        self._polled = 0
+        if self.config.get('COIL_REVISION_PUBSUB', True):
+            self._subscriber = Subscriber(db, 'site:rev',
+                                          self._revision_announced, logger,
+                                          self._poll_revision)
+        else:
+            self._subscriber = None
+        self._entries = {}
+        self._by_path = {}
+        self._resident = collections.OrderedDict()
+        self._lock = threading.Lock()
         self._timeline = []
         self._posts = []
         self._all_posts = []
         self._pages = []
 
-        self.scan_posts()
+        if scan:
+            self.scan_posts()
+        else:
+            self._release_site()
+            self.reload_site()
+
+    def _materialize(self, handle):
+        """Initialize the full Post of a handle, evicting old ones."""
+        entry = handle._entry
+        post = Post(entry[0], self.config, entry[1], entry[2], entry[3],
+                    self.messages, self._site.compilers[entry[4]])
+        with self._lock:
+            handle._post = post
+            self._resident.pop(handle.source_path, None)
+            self._resident[handle.source_path] = handle
+            while len(self._resident) > self.cache_size:
+                _, old = self._resident.popitem(last=False)
+                old._post = None
+        return post
+
+    def _load_entries(self, paths=None):
+        """Load entries from the database (all of them if paths is None)."""
+        if paths is None:
+            data = self.db.hgetall('site:entries').values()
+        elif paths:
+            data = self.db.hmget('site:entries', paths)
+        else:
+            data = []
+        return [json.loads(d.decode('utf-8')) for d in data if d is not None]
+
+    def _read_changes(self, rev):
+        """Read the changes between the current revision and rev.
+
+        Returns None if the change log does not cover all of them.
+        """
+        if (self.revision == '' or rev < self.revision or
+                rev - self.revision > self.changelog_size):
+            return None
+        keys = ['site:changes:{0}'.format(r)
+                for r in range(self.revision + 1, rev + 1)]
+        changes = self.db.mget(keys)
+        if None in changes:
+            return None
+        return [json.loads(c.decode('utf-8')) for c in changes]
+
+    def _apply_changes(self, removed, entries):
+        """Apply changes to the in-memory site.
+
+        :param list removed: Source paths of removed posts
+        :param list entries: Entries of added and modified posts
+        """
+        by_path = dict(self._by_path)
+        with self._lock:
+            for path in removed:
+                self._entries.pop(path, None)
+                by_path.pop(path, None)
+                self._resident.pop(path, None)
+            for entry in entries:
+                path = entry[0]
+                self._entries[path] = entry
+                by_path[path] = PostHandle(self, entry)
+                self._resident.pop(path, None)
+        # Swap the index in one go, so lookups never see a partial update.
+        self._by_path = by_path
+        self._update_lists()
+
+    def _update_lists(self):
+        """Recreate the timeline and post lists from entries."""
+        order = sorted(self._entries.values(),
+                       key=lambda e: (e[6], e[0]), reverse=True)
+        self._timeline = [self._by_path[e[0]] for e in order]
+        self._posts = [self._by_path[e[0]] for e in order if e[5]]
+        self._all_posts = [self._by_path[e[0]] for e in order if e[2]]
+        self._pages = [self._by_path[e[0]] for e in order if not e[2]]
 
     def reload_site(self):
         """Reload the site from the database."""
-        rev = int(self.db.get('site:rev'))
-        if rev != self.revision and self.db.exists('site:rev'):
-            timeline = self.db.lrange('site:timeline', 0, -1)
-            self._timeline = []
-            for data in timeline:
-                data = json.loads(data.decode('utf-8'))
-                self._timeline.append(Post(data[0], self.config, data[1],
-                                           data[2], data[3], self.messages,
-                                           self._site.compilers[data[4]]))
-
-            self._read_indexlist('posts')
-            self._read_indexlist('all_posts')
-            self._read_indexlist('pages')
-
-            self.revision = rev
-            self.logger.info("Site updated to revision {0}.".format(rev))
-        elif rev == self.revision and self.db.exists('site:rev'):
-            pass
-        else:
+        rev = self.db.get('site:rev')
+        if rev is None:
             self.logger.warn("Site needs rescanning.")
+            return
+        rev = self._known_revision = int(rev)
+        if rev == self.revision:
+            return
 
-    def _read_indexlist(self, name):
-        """Read a list of indexes."""
-        setattr(self, '_' + name, [self._timeline[int(i)] for i in
-                                   self.db.lrange('site:{0}'.format(name), 0,
-                                                  -1)])
+        changes = self._read_changes(rev)
+        if changes is None:
+            entries = self._load_entries()
+            new_paths = set(e[0] for e in entries)
+            removed = [p for p in self._entries if p not in new_paths]
+            self.logger.info("Site reloaded at revision {0}.".format(rev))
+        else:
+            removed = set()
+            changed = set()
+            for c in changes:
+                removed.update(c['removed'])
+                changed.difference_update(c['removed'])
+                changed.update(c['added'] + c['modified'])
+                removed.difference_update(c['added'])
+            entries = self._load_entries(list(changed))
+            self.logger.info("Site updated to revision {0} ({1} changed, "
+                             "{2} removed).".format(rev, len(changed),
+                                                    len(removed)))
 
-    def _write_indexlist(self, name):
-        """Write a list of indexes."""
-        d = [self._site.timeline.index(p) for p in getattr(self._site, name)]
-        self.db.delete('site:{0}'.format(name))
-        if d:
-            self.db.rpush('site:{0}'.format(name), *d)
+        self._apply_changes(removed, entries)
+        self.revision = rev
 
-    def scan_posts(self, really=True, ignore_quit=False, quiet=True):
-        """Rescan the site."""
-        while (self.db.exists('site:lock') and
-               int(self.db.get('site:lock')) != 0):
-            self.logger.info("Waiting for DB lock...")
-            time.sleep(0.5)
-        self.db.incr('site:lock')
-        self.logger.info("Lock acquired.")
-        self.logger.info("Scanning site...")
+    def _release_site(self):
+        """Drop the posts kept by Nikola after a scan; we use handles.
+
+        Nikola still considers the site scanned, so commands (like
+        ``new_post``) do not scan it again.
+        """
+        for name in _SCAN_RESULTS:
+            value = getattr(self._site, name, None)
+            if isinstance(value, list):
+                del value[:]
+            elif isinstance(value, dict):
+                value.clear()
+        self._site._scanned = True
+
+    def _write_author_index(self, pipe, added, removed, modified, entries):
+        """Update the per-author indexes (sorted by date)."""
+        if not self.db.exists('site:author_index'):
+            # Build the indexes from scratch.
+            full = dict(self._entries)
+            full.update(entries)
+            for path in removed:
+                full.pop(path, None)
+            entries = full
+            added = list(full)
+            removed = modified = []
+        for path in removed + modified:
+            old = self._entries[path]
+            pipe.zrem(_author_key(old[11], old[2]), path)
+        new = {}
+        for path in added + modified:
+            entry = entries[path]
+            new.setdefault(_author_key(entry[11], entry[2]), []).extend(
+                [entry[6], path])
+        for key, args in new.items():
+            pipe.zadd(key, *args)
+        pipe.set('site:author_index', '1')
+
+    def _write_changes(self, added, removed, modified, entries):
+        """Write changes to the database and bump the revision.
+
+        Everything is written in a single transaction, so readers never see
+        a partial update.  The lock must be held and the proxy up to date;
+        both are checked in the transaction, so a writer whose lock expired
+        cannot overwrite a revision written by another one.
+
+        :raises SiteLockLost: if the lock expired or the revision changed
+        """
+        rev = (self.revision or 0) + 1
+
+        def _write(pipe):
+            if not self.lock.holds(pipe):
+                raise SiteLockLost("The lock expired before the changes were "
+                                   "written; consider increasing "
+                                   "COIL_LOCK_TIMEOUT.")
+            current = int(pipe.get('site:rev') or 0)
+            if current != rev - 1:
+                raise SiteLockLost("Revision {0} was written by another "
+                                   "worker.".format(current))
+            pipe.multi()
+            self._queue_changes(pipe, rev, added, removed, modified, entries)
+
+        self.db.transaction(_write, self.lock.name, 'site:rev')
+        return rev
 
+    def _queue_changes(self, pipe, rev, added, removed, modified, entries):
+        """Queue the writes of a revision in a transaction."""
+        self._write_author_index(pipe, added, removed, modified, entries)
+        if added or modified:
+            pipe.hmset('site:entries', dict(
+                (path, json.dumps(entries[path]))
+                for path in added + modified))
+        if removed:
+            pipe.hdel('site:entries', *removed)
+        if len(added) + len(removed) + len(modified) <= self.changelog_size:
+            # Huge changes are cheaper to handle with a full reload.
+            pipe.set('site:changes:{0}'.format(rev), json.dumps(
+                {'added': added, 'removed': removed, 'modified': modified}))
+        pipe.delete('site:changes:{0}'.format(rev - self.changelog_size))
+        pipe.set('site:rev', rev)
+        pipe.publish('site:rev', rev)
+
+    def _scan_posts(self, really, ignore_quit, quiet):
+        """Rescan the site and write the changes (with the lock held)."""
         self._site.scan_posts(really, ignore_quit, quiet)
+        # Catch up with other writers, so we only write what we changed.
+        self.reload_site()
 
-        timeline = []
+        entries = {}
         for post in self._site.timeline:
-            data = [post.source_path, post.folder, post.is_post,
-                    post._template_name, post.compiler.name]
-            timeline.append(json.dumps(data))
-        self.db.delete('site:timeline')
-        if timeline:
-            self.db.rpush('site:timeline', *timeline)
+            entries[post.source_path] = _post_entry(post)
+        self._release_site()
+        added = [p for p in entries if p not in self._entries]
+        removed = [p for p in self._entries if p not in entries]
+        modified = [p for p in entries if p in self._entries and
+                    self._entries[p] != entries[p]]
 
-        self._write_indexlist('posts')
-        self._write_indexlist('all_posts')
-        self._write_indexlist('pages')
+        if (added or removed or modified or self.revision == '' or
+                not self.db.exists('site:author_index')):
+            self._commit(added, removed, modified, entries)
 
-        self.db.incr('site:rev')
+    def _commit(self, added, removed, modified, entries):
+        """Write changes and apply them to the in-memory site."""
+        self.revision = self._write_changes(added, removed, modified, entries)
+        self._known_revision = self.revision
+        self._apply_changes(removed, [entries[p] for p in added + modified])
 
-        self.db.decr('site:lock')
-        self.logger.info("Lock released.")
+    def scan_posts(self, really=True, ignore_quit=False, quiet=True):
+        """Rescan the site."""
+        with self.lock:
+            self.logger.info("Scanning site...")
+            self._scan_posts(really, ignore_quit, quiet)
         self.logger.info("Site scanned.")
-        self.reload_site()
+
+    def rescan_paths(self, paths):
+        """Rescan some source paths, without scanning the whole site.
+
+        Paths of added, modified and removed posts (and their translations)
+        are all accepted.
+
+        :param list paths: Paths to rescan
+        """
+        with self.lock:
+            self.reload_site()
+            added = []
+            removed = []
+            modified = []
+            entries = {}
+            for path in set(base_path(self._site, p) for p in paths):
+                post = None
+                if os.path.exists(path):
+                    post = load_post(self._site, path)
+                if post is None:
+                    if path in self._entries:
+                        removed.append(path)
+                    continue
+                entries[path] = _post_entry(post)
+                if path not in self._entries:
+                    added.append(path)
+                elif self._entries[path] != entries[path]:
+                    modified.append(path)
+            if added or removed or modified:
+                self._commit(added, removed, modified, entries)
+        self.logger.info("Rescanned {0} path(s).".format(len(paths)))
+
+    def update_post(self, path):
+        """Rescan a post that was added or modified."""
+        self.rescan_paths([path])
+
+    def remove_post(self, path):
+        """Remove a post that was deleted."""
+        self.rescan_paths([path])
+
+    def _revision_announced(self, rev):
+        """Handle a revision announcement."""
+        self._known_revision = int(rev)
+
+    def _poll_revision(self):
+        """Read the current revision from the database."""
+        rev = self.db.get('site:rev')
+        self._known_revision = None if rev is None else int(rev)
+        self._polled = time.time()
+
+    def _refresh(self):
+        """Reload the site if there is a newer revision."""
+        max_age = self.max_age
+        if self._subscriber is not None:
+            self._subscriber.start()
+            if self._subscriber.connected:
+                max_age = self.pubsub_max_age
+        if time.time() - self._polled >= max_age:
+            self._poll_revision()
+        if self._known_revision != self.revision:
+            self.reload_site()
+
+    @property
+    def post_index(self):
+        """Get a dict of posts by source path, reloading the site if needed."""
+        self._refresh()
+        return self._by_path
+
+    def author_posts(self, uid):
+        """Get posts and pages of an author, and those without an author.
+
+        :param uid: UID of the author
+        :return: posts and pages, newest first
+        :rtype: tuple
+        """
+        self._refresh()
+        pipe = self.db.pipeline(transaction=False)
+        for owner in (str(uid), ''):
+            pipe.zrange(_author_key(owner, True), 0, -1)
+            pipe.zrange(_author_key(owner, False), 0, -1)
+        own_posts, own_pages, posts, pages = pipe.execute()
+        return (self._handles(own_posts + posts),
+                self._handles(own_pages + pages))
+
+    def _handles(self, paths):
+        """Get handles for source paths from an index, newest first."""
+        by_path = self._by_path
+        handles = []
+        for path in paths:
+            handle = by_path.get(path.decode('utf-8'))
+            if handle is not None:
+                handles.append(handle)
+        handles.sort(key=lambda h: (h._entry[6], h.source_path), reverse=True)
+        return handles
 
     @property
     def timeline(self):
         """Get timeline, reloading the site if needed."""
-        rev = int(self.db.get('site:rev'))
-        if rev != self.revision:
-            self.reload_site()
-
+        self._refresh()
         return self._timeline
 
     @property
     def posts(self):
         """Get posts, reloading the site if needed."""
-        rev = int(self.db.get('site:rev'))
-        if rev != self.revision:
-            self.reload_site()
-
+        self._refresh()
         return self._posts
 
     @property
     def all_posts(self):
         """Get all_posts, reloading the site if needed."""
-        rev = self.db.get('site:rev')
-        if int(rev) != self.revision:
-            self.reload_site()
-
+        self._refresh()
         return self._all_posts
 
     @property
     def pages(self):
         """Get pages, reloading the site if needed."""
-        rev = self.db.get('site:rev')
-        if int(rev) != self.revision:
-            self.reload_site()
-
+        self._refresh()
         return self._pages
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Coil CMS v1.2.0
+# Copyright © 2014-2018 Chris Warrick, Roberto Alsina, Henry Hirsch et al.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, unicode_literals
+import os
+import socket
+import threading
+import time
+
+__all__ = ['watch']
+
+# Seconds after which the watcher is considered dead.
+HEARTBEAT_TTL = 15
+
+
+class PathBatcher(object):
+    """Collect changed paths from watchdog events."""
+
+    def __init__(self, debounce):
+        """Initialize a batcher.
+
+        :param float debounce: Seconds without events before a batch is ready
+        """
+        self.debounce = debounce
+        self.paths = set()
+        self.first = None
+        self.last = None
+        self.lock = threading.Lock()
+
+    def dispatch(self, event):
+        """Handle a watchdog event.
+
+        Directories moved, deleted or created as a whole are collected too;
+        changes to files in them come as separate events.
+        """
+        if event.is_directory and event.event_type == 'modified':
+            return
+        with self.lock:
+            self.paths.add(event.src_path)
+            dest = getattr(event, 'dest_path', None)
+            if dest:
+                self.paths.add(dest)
+            self.last = time.time()
+            if self.first is None:
+                self.first = self.last
+
+    def take(self):
+        """Get a batch of paths, if it is ready.
+
+        A batch is ready when nothing changed for ``debounce`` seconds, or if
+        changes have been coming in for ten times as long.
+        """
+        with self.lock:
+            now = time.time()
+            if not self.paths or (now - self.last < self.debounce and
+                                  now - self.first < 10 * self.debounce):
+                return set()
+            paths = self.paths
+            self.paths = set()
+            self.first = self.last = None
+            return paths
+
+    def requeue(self, paths):
+        """Put back a batch that could not be handled, to retry it later."""
+        with self.lock:
+            self.paths.update(paths)
+            self.last = time.time()
+            if self.first is None:
+                self.first = self.last
+
+
+def _source_paths(paths, indexed):
+    """Convert changed paths into source paths of posts.
+
+    :param set paths: Changed files and directories
+    :param indexed: Source paths of the posts in the index
+    """
+    sources = set()
+    for path in paths:
+        path = os.path.relpath(path)
+        # A directory that went away takes its posts with it, and one that
+        # was moved in brings its files.
+        prefix = path + os.sep
+        sources.update(p for p in indexed if p.startswith(prefix))
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path, followlinks=True):
+                sources.update(_source_paths(
+                    [os.path.join(root, n) for n in names], ()))
+            continue
+        base, ext = os.path.splitext(path)
+        if ext == '.meta':
+            # Metadata belongs to the post stored next to it.
+            folder, name = os.path.split(base)
+            try:
+                names = os.listdir(folder or '.')
+            except OSError:
+                names = []
+            sources.update(os.path.join(folder, n) for n in names
+                           if n.startswith(name + '.') and
+                           not n.endswith('.meta'))
+            continue
+        sources.add(path)
+    return sources
+
+
+def watch(debounce=1.0):
+    """Watch post and page folders, updating the site index on changes.
+
+    :param float debounce: Seconds to wait for more changes before rescanning
+    :return: exit code
+    :rtype: int
+    """
+    try:
+        from watchdog.observers import Observer
+    except ImportError:
+        print("FATAL: the watcher requires watchdog (pip install watchdog)")
+        return 255
+    import coil.web
+    if not coil.web.app:
+        print("FATAL: no conf.py found")
+        return 255
+    if coil.web.db is None:
+        print("FATAL: the watcher is not available in Limited Mode")
+        return 255
+
+    db = coil.web.db
+    site = coil.web.site
+    logger = coil.web.app.logger
+    identity = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+
+    batcher = PathBatcher(debounce)
+    observer = Observer()
+    folders = set(os.path.dirname(wildcard) or '.' for wildcard, _, _, _ in
+                  coil.web._site.config['post_pages'])
+    for folder in folders:
+        if os.path.isdir(folder):
+            observer.schedule(batcher, folder, recursive=True)
+            logger.info("Watching {0}".format(folder))
+    observer.start()
+
+    try:
+        while True:
+            db.set('site:watcher', identity, ex=HEARTBEAT_TTL)
+            paths = batcher.take()
+            if paths:
+                sources = _source_paths(paths, site.post_index)
+                logger.info("Changes detected in {0} file(s).".format(
+                    len(sources)))
+                try:
+                    site.rescan_paths(sources)
+                except Exception:
+                    # Keep watching (Redis may be restarting, a post may be
+                    # half-written); the next batch includes these paths.
+                    logger.exception("Rescan failed, will retry.")
+                    batcher.requeue(paths)
+            time.sleep(min(debounce, 1.0) / 2)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        observer.stop()
+        observer.join()
+        db.delete('site:watcher')
+    return 0
@@ -27,40 +27,121 @@
 
 from __future__ import print_function, unicode_literals
 import json
+import multiprocessing
 import os
 import sys
 import io
+import time
 import pkg_resources
 import nikola.__main__
 import logbook
 import redis
 import rq
-import operator
 import requests
 import coil.tasks
+from blinker import signal
 from nikola.utils import (unicode_str, get_logger, ColorfulStderrHandler,
                           write_metadata, TranslatableSetting)
 import nikola.plugins.command.new_post
-from flask import (Flask, request, redirect, send_from_directory, g, session,
-                   url_for)
+from flask import (Flask, Response, request, redirect, send_from_directory, g,
+                   session, stream_with_context, url_for)
 from flask.ext.login import (LoginManager, login_required, login_user,
                              logout_user, current_user, make_secure_token)
 from passlib.hash import bcrypt_sha256
-from coil.utils import USER_FIELDS, PERMISSIONS, PERMISSIONS_E, SiteProxy
+from coil.utils import (USER_FIELDS, PERMISSIONS, PERMISSIONS_E, SiteProxy,
+                        UserCache, allocate_uid, base_path, build_targets,
+                        build_user_index, decode_user, index_user, load_post,
+                        load_users, search_users)
 from coil.forms import (LoginForm, NewPostForm, NewPageForm, DeleteForm,
                         UserDeleteForm, UserEditForm, AccountForm,
-                        PermissionsForm, UserImportForm, PwdHashForm)
+                        PermissionsForm, UserImportForm, PwdHashForm,
+                        PublishForm)
 
 _site = None
 site = None
 app = None
 db = None
 q = None
+local_build = None
+user_cache = None
+# Users shown on a page of the user list.
+USERS_PER_PAGE = 50
+# Streams are closed after this many seconds; clients reconnect or poll.
+STREAM_LIFETIME = 300
 
 
 def scan_site():
     """Rescan the site."""
     site.scan_posts(really=True, ignore_quit=False, quiet=True)
+    if db is None:
+        _index_site()
+
+
+def _index_site():
+    """Index posts by source path and author (in single-user mode)."""
+    site.coil_post_index = {}
+    site.coil_author_index = {}
+    for p in site.timeline:
+        site.coil_post_index[p.source_path] = p
+        posts, pages = site.coil_author_index.setdefault(
+            p.meta('author.uid') or '', ([], []))
+        if p.is_post:
+            posts.append(p)
+        else:
+            pages.append(p)
+
+
+def queue_scan(paths=None):
+    """Rescan the site in the background, using rq.
+
+    Only one scan job is queued at a time; it takes care of all paths queued
+    before it starts.
+
+    :param list paths: Paths to rescan (None to scan the whole site)
+    """
+    pipe = db.pipeline()
+    if paths is None:
+        pipe.set('site:scan:full', '1')
+    else:
+        pipe.sadd('site:scan:pending', *paths)
+    pipe.set('site:scan:queued', '1', nx=True)
+    if pipe.execute()[-1]:
+        q.enqueue_call(func=coil.tasks.scan,
+                       args=(app.config['REDIS_URL'],
+                             app.config['NIKOLA_ROOT']))
+
+
+def rescan_post(path):
+    """Rescan a single post that was added, modified or removed.
+
+    :param str path: Source path of the post
+    """
+    if db is not None:
+        if app.config['COIL_ASYNC_SCAN']:
+            queue_scan([path])
+        else:
+            site.rescan_paths([path])
+        return
+
+    path = base_path(site, path)
+    lists = ('timeline', 'posts', 'all_posts', 'pages')
+    for name in lists:
+        setattr(site, name, [p for p in getattr(site, name)
+                             if p.source_path != path])
+    post = None
+    if os.path.exists(path):
+        post = load_post(site, path)
+    if post is not None:
+        belongs = (True, post.use_in_feeds, post.is_post, not post.is_post)
+        for name, b in zip(lists, belongs):
+            if not b:
+                continue
+            posts = getattr(site, name)
+            i = 0
+            while i < len(posts) and posts[i].date >= post.date:
+                i += 1
+            posts.insert(i, post)
+    _index_site()
 
 
 def configure_url(url):
@@ -74,7 +155,7 @@ def configure_url(url):
 
 def configure_site():
     """Configure the Nikola site for Coil CMS."""
-    global _site, site, db, q
+    global _site, site, db, q, local_build, user_cache
 
     nikola.__main__._RETURN_DOITNIKOLA = True
     _dn = nikola.__main__.main([])
@@ -126,14 +207,38 @@ def configure_site():
         {'enabled': False, 'site_key': '', 'secret_key': ''})
     app.config['COIL_USERS_PREVENT_EDITING'] = _site.config.get('COIL_USERS_PREVENT_EDITING', [])
     app.config['COIL_LIMITED'] = _site.config.get('COIL_LIMITED', False)
+    app.config['COIL_ASYNC_SCAN'] = _site.config.get('COIL_ASYNC_SCAN', False)
+    app.config['COIL_BUILD_DEBOUNCE'] = _site.config.get(
+        'COIL_BUILD_DEBOUNCE', 2)
+    app.config['COIL_BUILD_PROCESSES'] = _site.config.get(
+        'COIL_BUILD_PROCESSES', 1)
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    app.config['COIL_BUILD_MAX_PROCESSES'] = _site.config.get(
+        'COIL_BUILD_MAX_PROCESSES',
+        max(cpus, app.config['COIL_BUILD_PROCESSES']))
+    app.config['COIL_ORPHANS_DRY_RUN'] = _site.config.get(
+        'COIL_ORPHANS_DRY_RUN', False)
     app.config['REDIS_URL'] = _site.config.get('COIL_REDIS_URL',
                                                'redis://localhost:6379/0')
+    app.config['QUEUE_URL'] = _site.config.get('COIL_QUEUE_URL',
+                                               app.config['REDIS_URL'])
     if app.config['COIL_LIMITED']:
         app.config['COIL_USERS'] = _site.config.get('COIL_USERS', {})
         _site.coil_needs_rebuild = '0'
+        local_build = coil.tasks.LocalBuild(
+            app.config['NIKOLA_ROOT'], _site.config['OUTPUT_FOLDER'],
+            app.config['COIL_ORPHANS_DRY_RUN'],
+            app.config['COIL_BUILD_DEBOUNCE'])
     else:
         db = redis.StrictRedis.from_url(app.config['REDIS_URL'])
-        q = rq.Queue(name='coil', connection=db)
+        if app.config['QUEUE_URL'] == app.config['REDIS_URL']:
+            q = rq.Queue(name='coil', connection=db)
+        else:
+            q = rq.Queue(name='coil', connection=redis.StrictRedis.from_url(
+                app.config['QUEUE_URL']))
 
     _site.template_hooks['menu'].append(generate_menu)
     _site.template_hooks['menu_alt'].append(generate_menu_alt)
@@ -202,6 +307,8 @@ def configure_site():
         scan_site()
     else:
         site = SiteProxy(db, _site, app.logger)
+        if _site.config.get('COIL_USER_CACHE', True):
+            user_cache = UserCache(db, app.logger)
 
     configure_url(app.config['COIL_URL'])
 
@@ -394,10 +501,28 @@ def find_post(path):
     :return: A post matching the path
     :rtype: Post or None
     """
-    for p in site.timeline:
-        if p.source_path == path:
-            return p
-    return None
+    if db is not None:
+        index = site.post_index
+    else:
+        index = site.coil_post_index
+    return index.get(path)
+
+
+def author_posts(uid):
+    """Find posts and pages that an user can edit.
+
+    This includes posts without an author.
+
+    :param int uid: UID of the user
+    :return: posts and pages, newest first
+    :rtype: tuple
+    """
+    if db is not None:
+        return site.author_posts(uid)
+    own_posts, own_pages = site.coil_author_index.get(str(uid), ([], []))
+    posts, pages = site.coil_author_index.get('', ([], []))
+    return (sorted(own_posts + posts, key=lambda p: p.date, reverse=True),
+            sorted(own_pages + pages, key=lambda p: p.date, reverse=True))
 
 
 app = Flask('coil')
@@ -425,6 +550,9 @@ login_manager.unauthorized_callback = _unauthorized
 
 class User(object):
     """An user.  Compatible with Flask-Login."""
+
+    __slots__ = ['uid'] + USER_FIELDS + PERMISSIONS
+
     def __init__(self, uid, username, realname, password, email, active,
                  is_admin, can_edit_all_posts, wants_all_posts,
                  can_upload_attachments, can_rebuild_site,
@@ -484,20 +612,12 @@ def get_user(uid):
             uid = uid.decode('utf-8')
         except AttributeError:
             pass
-        d = db.hgetall('user:{0}'.format(uid))
-        if d:
-            nd = {}
-            # strings everywhere
-            for k in d:
-                try:
-                    nd[k.decode('utf-8')] = d[k].decode('utf-8')
-                except AttributeError:
-                    try:
-                        nd[k.decode('utf-8')] = d[k]
-                    except AttributeError:
-                        nd[k] = d[k]
-            for p in PERMISSIONS:
-                nd[p] = nd.get(p) == '1'
+        if user_cache is not None:
+            nd = user_cache.get(uid)
+        else:
+            d = db.hgetall('user:{0}'.format(uid))
+            nd = decode_user(d) if d else None
+        if nd:
             return User(uid=uid, **nd)
         else:
             return None
@@ -509,6 +629,29 @@ def get_user(uid):
             return None
 
 
+def get_users(uids):
+    """Get many users at once.
+
+    :param uids: UIDs to find
+    :return: the users, in the order of ``uids`` (missing users are skipped)
+    :rtype: list of User objects
+    """
+    if db is not None:
+        if user_cache is not None:
+            records = user_cache.get_many(uids)
+        else:
+            records = load_users(db, uids)
+        return [User(uid=uid, **records[uid]) for uid in
+                (int(u) for u in uids) if uid in records]
+    else:
+        users = []
+        for uid in uids:
+            user = get_user(uid)
+            if user:
+                users.append(user)
+        return users
+
+
 def find_user_by_name(username):
     """Get an user by their username.
 
@@ -517,7 +660,10 @@ def find_user_by_name(username):
     :rtype: User object or None
     """
     if db is not None:
-        uid = db.hget('users', username)
+        if user_cache is not None:
+            uid = user_cache.uid(username)
+        else:
+            uid = db.hget('users', username)
         if uid:
             return get_user(uid)
     else:
@@ -539,7 +685,40 @@ def write_user(user):
 
     for p in PERMISSIONS:
         udata[p] = '1' if getattr(user, p) else '0'
-    db.hmset('user:{0}'.format(user.uid), udata)
+
+    key = 'user:{0}'.format(user.uid)
+
+    def _write(pipe):
+        old = pipe.hmget(key, 'username', 'realname')
+        pipe.multi()
+        pipe.hmset(key, udata)
+        index_user(pipe, user.uid,
+                   decode_user(dict(zip(('username', 'realname'), old))),
+                   decode_user(udata))
+        UserCache.announce(pipe, user.uid)
+
+    db.transaction(_write, key)
+
+
+def write_permissions(changes):
+    """Change permissions of many users in one transaction.
+
+    Only the given permissions are written.
+
+    :param dict changes: New values of permissions by UID
+    """
+    pipe = db.pipeline()
+    for uid, perms in changes.items():
+        pipe.hmset('user:{0}'.format(uid),
+                   dict((p, '1' if v else '0') for p, v in perms.items()))
+        if 'active' in perms:
+            # Names did not change, the other indexes stay valid.
+            if perms['active']:
+                pipe.sadd('users:active', uid)
+            else:
+                pipe.srem('users:active', uid)
+        UserCache.announce(pipe, uid)
+    pipe.execute()
 
 
 @app.route('/login/', methods=['GET', 'POST'])
@@ -649,21 +828,15 @@ def index():
         pages = site.pages
     else:
         wants = False
-        posts = []
-        pages = []
-        for p in site.timeline:
-            if (p.meta('author.uid') and
-                    p.meta('author.uid') != str(current_user.uid)):
-                continue
-            if p.is_post:
-                posts.append(p)
-            else:
-                pages.append(p)
+        posts, pages = author_posts(current_user.uid)
 
     context['posts'] = posts
     context['pages'] = pages
     context['title'] = 'Posts & Pages'
     context['wants'] = wants
+    context['scan_pending'] = (db is not None and
+                               app.config['COIL_ASYNC_SCAN'] and
+                               db.exists('site:scan:queued'))
     return render('coil_index.tmpl', context)
 
 
@@ -717,12 +890,18 @@ def edit(path):
             meta.pop('content', '')
             with io.open(meta_path, 'w+', encoding='utf-8') as fh:
                 fh.write(write_metadata(meta))
-        scan_site()
+        rescan_post(path)
         if db is not None:
             db.set('site:needs_rebuild', '1')
+            _request_rebuild(start=False)
         else:
             site.coil_needs_rebuild = '1'
-        post = find_post(path)
+            local_build.request(start=False)
+        if db is not None and app.config['COIL_ASYNC_SCAN']:
+            # The index is updated later; show the post as it was saved.
+            post = load_post(_site, path)
+        else:
+            post = find_post(path)
         context['action'] = 'save'
     else:
         context['action'] = 'edit'
@@ -733,26 +912,61 @@ def edit(path):
                     '\n\n', 1)[1]
 
     context['post'] = post
-    users = []
-    if db is not None:
-        uids = db.hgetall('users').values()
-        for u in uids:
-            u = u.decode('utf-8')
-            realname, active = db.hmget('user:{0}'.format(u),
-                                        'realname', 'active')
-            if active in (u'1', b'1'):
-                users.append((u, realname.decode('utf-8')))
-    else:
-        for u, d in app.config['COIL_USERS'].items():
-            if d['active']:
-                users.append((int(u), d['realname']))
-    context['users'] = sorted(users)
+    authors, more = _find_authors()
+    if current_auid not in [u.uid for u in authors]:
+        author = get_user(current_auid)
+        if author is not None:
+            authors.insert(0, author)
+    context['users'] = [(u.uid, u.realname) for u in authors]
+    context['more_users'] = more is not None
     context['current_auid'] = current_auid
+    context['publishform'] = PublishForm()
+    context['published'] = request.args.get('published')
     context['title'] = 'Editing {0}'.format(post.title())
     context['is_html'] = post.compiler.name == 'html'
     return render('coil_post_edit.tmpl', context)
 
 
+def _find_authors(query='', start=0, count=50):
+    """Find active users by the start of their real name.
+
+    :return: users, and the position of the next page (or None)
+    :rtype: tuple
+    """
+    if db is not None:
+        build_user_index(db)
+        uids, more = search_users(db, query, 'realname', start, count,
+                                  active=True)
+        return get_users(uids), more
+    query = query.lower()
+    users = sorted((u for u in get_users(app.config['COIL_USERS'])
+                    if u.active and u.realname.lower().startswith(query)),
+                   key=lambda u: u.realname.lower())
+    more = start + count if len(users) > start + count else None
+    return users[start:start + count], more
+
+
+@app.route('/api/users/')
+@login_required
+def api_users():
+    """Find authors for the author picker.
+
+    :param str q: Start of the real name
+    :param int start: Position of the page to get
+    """
+    if not current_user.can_transfer_post_authorship:
+        return error("Not authorized to transfer post authorship.", 401)
+    try:
+        start = max(0, int(request.args.get('start', 0)))
+    except ValueError:
+        return error("Bad Request", 400)
+    users, more = _find_authors(request.args.get('q', ''), start)
+    return json.dumps({
+        'users': [{'uid': u.uid, 'realname': u.realname} for u in users],
+        'next': more,
+    })
+
+
 @app.route('/delete/', methods=['POST'])
 @login_required
 def delete():
@@ -775,77 +989,274 @@ def delete():
     if post.is_two_file:
         meta_path = os.path.splitext(path)[0] + '.meta'
         os.unlink(meta_path)
-    scan_site()
+    rescan_post(path)
     if db is not None:
         db.set('site:needs_rebuild', '1')
+        _request_rebuild(start=False)
     else:
         site.coil_needs_rebuild = '1'
+        local_build.request(start=False)
     return redirect(url_for('index'))
 
 
-@app.route('/api/rebuild/')
+@app.route('/publish/<path:path>', methods=['POST'])
 @login_required
-def api_rebuild():
-    """Rebuild the site (internally)."""
-    if db is None:
-        return '{"error": "single-user mode"}'
-    build_job = q.fetch_job('build')
-    orphans_job = q.fetch_job('orphans')
-
-    if not build_job and not orphans_job:
-        build_job = q.enqueue_call(func=coil.tasks.build,
-                                   args=(app.config['REDIS_URL'],
-                                         app.config['NIKOLA_ROOT'],
-                                         ''),
-                                   job_id='build')
-        orphans_job = q.enqueue_call(func=coil.tasks.orphans,
-                                     args=(app.config['REDIS_URL'],
-                                           app.config['NIKOLA_ROOT']),
-                                     job_id='orphans', depends_on=build_job)
-
-    d = json.dumps({'build': build_job.meta, 'orphans': orphans_job.meta})
-
-    if ('status' in build_job.meta and
-            build_job.meta['status'] is not None and
-            'status' in orphans_job.meta and
-            orphans_job.meta['status'] is not None):
-        rq.cancel_job('build', db)
-        rq.cancel_job('orphans', db)
+def publish(path):
+    """Build only the pages that depend on a post.
+
+    The full rebuild is still needed (and still requested by saving) to
+    update everything else, like archives and author pages.
+
+    :param path: Path to post to publish.
+    """
+    form = PublishForm()
+    post = find_post(path)
+    if post is None:
+        return error("No such post or page.", 404)
+    if not form.validate():
+        return error("Bad Request", 400)
+    if not current_user.can_rebuild_site:
+        return error('You are not permitted to rebuild the site.</p>'
+                     '<p class="lead">Contact an administartor for '
+                     'more information.', 401)
+
+    current_auid = int(post.meta('author.uid') or current_user.uid)
+    if (not current_user.can_edit_all_posts and
+            current_auid != current_user.uid):
+        return error("Cannot edit posts of other users.", 401)
+
+    targets = build_targets(_site, post)
+    if db is not None:
+        job = q.enqueue_call(func=coil.tasks.publish,
+                             args=(app.config['REDIS_URL'],
+                                   app.config['NIKOLA_ROOT'], targets))
+        db.set('site:publish:job', job.id)
+    else:
+        local_build.publish(targets)
+    return redirect(url_for('edit', path=path, published='queued'))
+
+
+@app.route('/api/publish/')
+@login_required
+def api_publish():
+    """Get the status and log of the last publish.
+
+    The log is only sent once the publish has started (before that, it is
+    the log of the previous one).
+
+    :param int offset: Number of log lines already seen
+    """
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return error("Bad Request", 400)
+    if db is not None:
+        job_id = db.get('site:publish:job')
+        job = q.fetch_job(job_id.decode('utf-8')) if job_id else None
+        meta = _meta(job)
+        log = coil.tasks.BuildLog(db, 'publish').read(offset)
+    else:
+        meta = local_build.meta['publish']
+        offset, log = local_build.logs['publish'].read(offset)
+    if not meta:
+        log = []
+    return json.dumps({'publish': meta, 'log': log, 'offset': offset})
+
+
+def _request_rebuild(mode='', start=True, processes=None):
+    """Request a rebuild, coalesced with the one in progress (full mode).
+
+    :param str mode: ``force`` to rebuild everything, or empty
+    :param bool start: Whether to start a rebuild if none is in progress
+    :param int processes: Number of build processes (default:
+                          ``COIL_BUILD_PROCESSES``)
+    """
+    if processes is None:
+        processes = app.config['COIL_BUILD_PROCESSES']
+    return coil.tasks.request_build(db, q, app.config['REDIS_URL'],
+                                    app.config['NIKOLA_ROOT'], mode,
+                                    app.config['COIL_BUILD_DEBOUNCE'], start,
+                                    processes,
+                                    _site.config['OUTPUT_FOLDER'],
+                                    app.config['COIL_ORPHANS_DRY_RUN'])
+
+
+def _rebuild_jobs():
+    """Get the build and orphans jobs of the current pipeline."""
+    jobs = db.hgetall('site:build:jobs')
+    if not jobs:
+        return None, None, None
+    return (q.fetch_job(jobs[b'build'].decode('utf-8')),
+            q.fetch_job(jobs[b'orphans'].decode('utf-8')),
+            jobs[b'build'].decode('utf-8'))
+
+
+def _meta(job):
+    """Get the metadata of a job that may not exist (yet)."""
+    return job.meta if job is not None else {}
+
+
+def _rebuild_done():
+    """Check whether rebuilds are done (including follow-ups)."""
+    if coil.tasks.build_state(db, q) == 'idle':
         db.set('site:needs_rebuild', '0')
         site.coil_needs_rebuild = '1'
+        return True
+    return False
 
+
+@app.route('/api/rebuild/')
+@login_required
+def api_rebuild():
+    """Rebuild the site (internally).
+
+    :param int build_offset: Number of build log lines already seen
+    :param int orphans_offset: Number of orphans log lines already seen
+    """
+    try:
+        build_offset = int(request.args.get('build_offset', 0))
+        orphans_offset = int(request.args.get('orphans_offset', 0))
+    except ValueError:
+        return error("Bad Request", 400)
+
+    if db is None:
+        d = json.dumps(local_build.state(build_offset, orphans_offset))
+        if local_build.idle:
+            site.coil_needs_rebuild = '0'
+        return d
+
+    build_job, orphans_job, pipeline = _rebuild_jobs()
+
+    d = json.dumps({
+        'pipeline': pipeline,
+        'build': _meta(build_job),
+        'orphans': _meta(orphans_job),
+        'build_log': coil.tasks.BuildLog(db, 'build').read(build_offset),
+        'build_offset': build_offset,
+        'orphans_log': coil.tasks.BuildLog(db, 'orphans').read(
+            orphans_offset),
+        'orphans_offset': orphans_offset,
+    })
+    _rebuild_done()
     return d
 
 
+def _next_message(pubsub, timeout):
+    """Wait for a pub/sub message for at most timeout seconds.
+
+    ``get_message`` cannot wait in redis-py 2.10, so this polls it.
+
+    :return: the message, or None
+    """
+    deadline = time.time() + timeout
+    while True:
+        message = pubsub.get_message()
+        if message is not None or time.time() >= deadline:
+            return message
+        time.sleep(0.1)
+
+
+@app.route('/api/rebuild/stream/')
+@login_required
+def api_rebuild_stream():
+    """Stream rebuild progress as Server-Sent Events.
+
+    The first event contains the full state, the following ones contain
+    changed job metadata or new log lines, as published by the tasks.  When
+    a follow-up build starts, the full state is sent again.  The stream ends
+    when rebuilds are done (also checked while nothing is published) or
+    after ``STREAM_LIFETIME`` seconds.
+    """
+    if db is None:
+        return error("Not available in single-user mode.", 404)
+    pubsub = db.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe('site:build:events')
+
+    def full_state():
+        """Get the full state (subscribe first, so nothing gets lost)."""
+        build_job, orphans_job, pipeline = _rebuild_jobs()
+        return {
+            'pipeline': pipeline,
+            'build': _meta(build_job),
+            'orphans': _meta(orphans_job),
+            'build_log': coil.tasks.BuildLog(db, 'build').read(),
+            'build_offset': 0,
+            'orphans_log': coil.tasks.BuildLog(db, 'orphans').read(),
+            'orphans_offset': 0,
+        }
+
+    def finished(event):
+        """Check whether an event may be the last one of a pipeline."""
+        return (event.get('orphans', {}).get('status') is not None or
+                event.get('build', {}).get('status') is False)
+
+    state = full_state()
+
+    def events():
+        """Generate events."""
+        pipeline = state['pipeline']
+        deadline = time.time() + STREAM_LIFETIME
+        try:
+            yield 'data: {0}\n\n'.format(json.dumps(state))
+            if finished(state) and _rebuild_done():
+                return
+            while time.time() < deadline:
+                message = _next_message(pubsub, 15)
+                if message is None:
+                    # The finished event may never come (e.g. a worker died).
+                    if _rebuild_done():
+                        break
+                    yield ': keepalive\n\n'
+                    continue
+                data = message['data'].decode('utf-8')
+                yield 'data: {0}\n\n'.format(data)
+                if not finished(json.loads(data)):
+                    continue
+                # The pipeline is done, or was replaced by a follow-up.
+                if _rebuild_done():
+                    break
+                new_state = full_state()
+                if new_state['pipeline'] != pipeline:
+                    pipeline = new_state['pipeline']
+                    yield 'data: {0}\n\n'.format(json.dumps(new_state))
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(events()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @app.route('/rebuild/')
 @app.route('/rebuild/<mode>/')
 @login_required
 def rebuild(mode=''):
-    """Rebuild the site with a nice UI."""
-    scan_site()  # for good measure
+    """Rebuild the site with a nice UI.
+
+    :param int processes: Number of build processes (admins only, at most
+                          ``COIL_BUILD_MAX_PROCESSES``)
+    """
+    if db is None or not db.exists('site:watcher'):
+        scan_site()  # for good measure (the watcher keeps the index current)
     if not current_user.can_rebuild_site:
         return error('You are not permitted to rebuild the site.</p>'
                      '<p class="lead">Contact an administartor for '
                      'more information.', 401)
+    processes = app.config['COIL_BUILD_PROCESSES']
+    if current_user.is_admin and 'processes' in request.args:
+        try:
+            processes = min(max(1, int(request.args['processes'])),
+                            app.config['COIL_BUILD_MAX_PROCESSES'])
+        except ValueError:
+            return error("Bad Request", 400)
     if db is not None:
         db.set('site:needs_rebuild', '-1')
-        if not q.fetch_job('build') and not q.fetch_job('orphans'):
-            b = q.enqueue_call(func=coil.tasks.build,
-                               args=(app.config['REDIS_URL'],
-                                     app.config['NIKOLA_ROOT'], mode),
-                               job_id='build')
-            q.enqueue_call(func=coil.tasks.orphans,
-                           args=(app.config['REDIS_URL'],
-                                 app.config['NIKOLA_ROOT']), job_id='orphans',
-                           depends_on=b)
-        return render('coil_rebuild.tmpl', {'title': 'Rebuild'})
+        _request_rebuild(mode, processes=processes)
     else:
-        status, outputb = coil.tasks.build_single(mode)
-        _, outputo = coil.tasks.orphans_single()
-        site.coil_needs_rebuild = '0'
-        return render('coil_rebuild_single.tmpl',
-                      {'title': 'Rebuild', 'status': '1' if status else '0',
-                       'outputb': outputb, 'outputo': outputo})
+        site.coil_needs_rebuild = '-1'
+        local_build.request(mode, processes)
+    return render('coil_rebuild.tmpl', {'title': 'Rebuild'})
 
 
 @app.route('/new/<obj>/', methods=['POST'])
@@ -857,6 +1268,17 @@ def new(obj):
     """
     title = request.form['title']
     _site.config['ADDITIONAL_METADATA']['author.uid'] = current_user.uid
+    created = []
+
+    def _created(sender, path, **kwargs):
+        """Remember the path of the new post."""
+        created.append(path)
+
+    signal('new_' + obj).connect(_created)
+    if db is not None:
+        # Nikola only needs the newest post (for scheduling); the site is
+        # not scanned again, handles are enough.
+        _site.timeline = site.timeline[:1]
     try:
         title = title.encode(sys.stdin.encoding)
     except (AttributeError, TypeError):
@@ -884,12 +1306,22 @@ def new(obj):
         return error("This {0} already exists!".format(obj), 500)
     finally:
         del _site.config['ADDITIONAL_METADATA']['author.uid']
+        signal('new_' + obj).disconnect(_created)
+        if db is not None:
+            _site.timeline = []
     # reload post list and go to index
-    scan_site()
+    if created:
+        rescan_post(created[0])
+    elif db is not None and app.config['COIL_ASYNC_SCAN']:
+        queue_scan()
+    else:
+        scan_site()
     if db is not None:
         db.set('site:needs_rebuild', '1')
+        _request_rebuild(start=False)
     else:
         site.coil_needs_rebuild = '1'
+        local_build.request(start=False)
     return redirect(url_for('index'))
 
 
@@ -1034,11 +1466,25 @@ def acp_users():
         alert = 'User undeleted.'
         alert_status = 'success'
 
-    uids = db.hgetall('users').values()
-    USERS = sorted([(int(i), get_user(i)) for i in uids], key=operator.itemgetter(0))
+    build_user_index(db)
+    query = request.args.get('q', '')
+    field = request.args.get('field', 'username')
+    if field not in ('username', 'realname'):
+        field = 'username'
+    try:
+        start = max(0, int(request.args.get('start', 0)))
+    except ValueError:
+        return error("Bad Request", 400)
+    uids, next_start = search_users(db, query, field, start, USERS_PER_PAGE)
+    USERS = [(user.uid, user) for user in get_users(uids)]
     return render('coil_users.tmpl',
                   context={'title': 'Users',
                            'USERS': USERS,
+                           'query': query,
+                           'field': field,
+                           'prev_start': (max(0, start - USERS_PER_PAGE)
+                                          if start else None),
+                           'next_start': next_start,
                            'alert': alert,
                            'alert_status': alert_status,
                            'delform': UserDeleteForm(),
@@ -1065,13 +1511,14 @@ def acp_users_edit():
     if action == 'new':
         if not data['username']:
             return error("No username to create specified.", 400)
-        uid = max(int(i) for i in db.hgetall('users').values()) + 1
+        uid = allocate_uid(db, data['username'])
+        if uid is None:
+            return error("User already exists.", 400)
         pf = [False for p in PERMISSIONS]
         pf[0] = True  # active
         pf[7] = True  # must_change_password
         user = User(uid, data['username'], '', '', '', *pf)
         write_user(user)
-        db.hset('users', user.username, user.uid)
         new = True
     else:
         user = get_user(data['uid'])
@@ -1164,69 +1611,93 @@ def acp_users_delete():
             _del=direction))
 
 
+def _permission_changes(data, uids):
+    """Parse changed permissions sent by the permissions page.
+
+    :param str data: JSON object mapping UIDs to objects mapping permissions
+                     to their new values
+    :param uids: UIDs of existing users
+    :return: new values of permissions by UID
+    :rtype: dict
+    :raises ValueError: if the data is malformed
+    """
+    changes = {}
+    known = set(uids)
+    try:
+        for uid, perms in json.loads(data or '{}').items():
+            uid = int(uid)
+            perms = dict((p, bool(v)) for p, v in perms.items()
+                         if p in PERMISSIONS)
+            if uid in known and perms:
+                changes[uid] = perms
+    except AttributeError:
+        raise ValueError("Changes must be objects.")
+    if current_user.uid in changes:
+        # Some permissions cannot apply to the current user.
+        changes[current_user.uid].update({
+            'is_admin': True, 'active': True,
+            'must_change_password': False})
+    return changes
+
+
 @app.route('/users/permissions/', methods=['GET', 'POST'])
 @login_required
 def acp_users_permissions():
-    """Change user permissions."""
+    """Change user permissions.
+
+    Rows are loaded from :func:`api_users_permissions` as the table scrolls,
+    and only changed permissions are sent back.
+    """
     if not current_user.is_admin:
         return error("Not authorized to edit users.", 401)
     if not db:
         return error('The ACP is not available in single-user mode.', 500)
 
     form = PermissionsForm()
-    users = []
-    uids = db.hgetall('users').values()
+    uids = sorted(int(i) for i in db.hvals('users'))
     if request.method == 'POST':
         if not form.validate():
             return error("Bad Request", 400)
-        for uid in uids:
-            user = get_user(uid)
-            for perm in PERMISSIONS:
-                if '{0}.{1}'.format(uid, perm) in request.form:
-                    setattr(user, perm, True)
-                else:
-                    setattr(user, perm, False)
-            if int(uid) == current_user.uid:
-                # Some permissions cannot apply to the current user.
-                user.is_admin = True
-                user.active = True
-                user.must_change_password = False
-            write_user(user)
-            users.append((uid, user))
+        try:
+            changes = _permission_changes(request.form.get('changes'), uids)
+        except ValueError:
+            return error("Bad Request", 400)
+        write_permissions(changes)
         action = 'save'
     else:
         action = 'edit'
 
-    def display_permission(user, permission):
-        """Display a permission."""
-        checked = 'checked' if getattr(user, permission) else ''
-        if permission == 'wants_all_posts' and not user.can_edit_all_posts:
-            # If this happens, permissions are damaged.
-            checked = ''
-        if (user.uid == current_user.uid and permission in [
-                'active', 'is_admin', 'must_change_password']):
-            disabled = 'disabled'
-        else:
-            disabled = ''
-        permission_a = permission
-        if permission == 'active':
-            permission_a = 'is_active'
-        d = ('<input type="checkbox" name="{0}.{1}" data-uid="{0}" '
-             'data-perm="{4}" class="u{0}" {2} {3}>')
-        return d.format(user.uid, permission, checked, disabled, permission_a)
-
-    if not users:
-        users = [(i, get_user(i)) for i in uids]
-
     return render('coil_users_permissions.tmpl',
                   context={'title': 'Permissions',
-                           'USERS': sorted(users),
-                           'UIDS': sorted(uids),
+                           'UIDS': uids,
                            'PERMISSIONS_E': PERMISSIONS_E,
                            'action': action,
                            'json': json,
-                           'form': form,
-                           'display_permission': display_permission})
+                           'form': form})
+
+
+@app.route('/api/users/permissions/')
+@login_required
+def api_users_permissions():
+    """Get permissions of some users, for the permissions page.
+
+    :param str uids: Comma-separated UIDs (at most 500)
+    """
+    if not current_user.is_admin:
+        return error("Not authorized to edit users.", 401)
+    if not db:
+        return error('The ACP is not available in single-user mode.', 500)
+    try:
+        uids = [int(i) for i in request.args.get('uids', '').split(',') if i]
+    except ValueError:
+        return error("Bad Request", 400)
+    if len(uids) > 500:
+        return error("Bad Request", 400)
+    users = [{'uid': user.uid,
+              'username': user.username,
+              'permissions': dict((p, getattr(user, p)) for p in PERMISSIONS)}
+             for user in get_users(uids)]
+    return json.dumps({'users': users})
 
 if not os.path.exists('._COIL_NO_CONFIG') and os.path.exists('conf.py'):
     configure_site()
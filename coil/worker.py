@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+
+# Coil CMS v1.2.0
+# Copyright © 2014-2018 Chris Warrick, Roberto Alsina, Henry Hirsch et al.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+from __future__ import print_function, unicode_literals
+import os
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+
+import nikola.__main__
+import nikola.utils
+from redis import StrictRedis
+from rq import Connection, Queue, Worker
+from rq.timeouts import BaseDeathPenalty
+
+from coil.targets import record_targets
+
+__all__ = ['ForkedNikola', 'ThreadedWorker', 'WarmSite', 'WarmWorker',
+           'warm_site', 'work']
+
+# The site loaded by this worker process (if any).
+_warm = None
+
+
+class WarmSite(object):
+    """A Nikola site that stays loaded between jobs."""
+
+    def __init__(self, sitedir):
+        """Initialize a warm site.
+
+        :param str sitedir: Path to the site (containing ``conf.py``)
+        """
+        self.sitedir = os.path.abspath(sitedir)
+        self.doit = None
+        self.stamp = None
+
+    def _stamp(self):
+        """Get modification times of the configuration and plugins."""
+        stamp = []
+        paths = [os.path.join(self.sitedir, 'conf.py')]
+        for root, dirs, files in os.walk(os.path.join(self.sitedir,
+                                                      'plugins')):
+            paths.extend(os.path.join(root, f) for f in files
+                         if not f.endswith(('.pyc', '.pyo')))
+        for path in sorted(paths):
+            try:
+                stamp.append((path, os.stat(path).st_mtime))
+            except OSError:
+                continue
+        return stamp
+
+    def refresh(self, logger):
+        """Load the site, or reload it if configuration or plugins changed.
+
+        :return: whether the site was (re)loaded
+        :rtype: bool
+        """
+        stamp = self._stamp()
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        oldcwd = os.getcwd()
+        os.chdir(self.sitedir)
+        try:
+            nikola.__main__._RETURN_DOITNIKOLA = True
+            doit = nikola.__main__.main([])
+            if not isinstance(doit, nikola.__main__.DoitNikola):
+                # conf.py is broken; builds fall back to a new interpreter,
+                # which will report the problem.
+                self.doit = None
+                logger.error("Cannot load the site in {0}.".format(
+                    self.sitedir))
+                return True
+            doit.nikola.init_plugins()
+            # Load the theme too, and do the expensive work only once.
+            doit.nikola.template_system
+            self.doit = doit
+            logger.info("Loaded the site in {0}.".format(self.sitedir))
+        finally:
+            os.chdir(oldcwd)
+        return True
+
+
+class ForkedNikola(object):
+    """A Nikola command, run in a child forked from a warm site.
+
+    Behaves like enough of :class:`subprocess.Popen` for the build tasks.
+    Only one of ``stdout`` and ``stderr`` may be a pipe.
+    """
+
+    def __init__(self, doit, args, cwd=None, stdout=None, stderr=None,
+                 targets=None):
+        """Fork and run the command.
+
+        :param doit: Loaded DoitNikola instance
+        :param list args: Nikola command line, like ``['build']``
+        :param str cwd: Directory to run the command in
+        :param str targets: File to write the targets of all tasks to, see
+                            :func:`coil.targets.record_targets`
+        :param stdout: ``subprocess.PIPE`` or None
+        :param stderr: ``subprocess.PIPE``, ``subprocess.STDOUT`` or None
+        """
+        self.returncode = None
+        self.stdout = self.stderr = None
+        out_r = out_w = err_r = err_w = None
+        if stdout == subprocess.PIPE:
+            out_r, out_w = os.pipe()
+        if stderr == subprocess.PIPE:
+            err_r, err_w = os.pipe()
+        self.pid = os.fork()
+        if self.pid == 0:
+            self._child(doit, args, cwd, targets, out_r, out_w, err_r, err_w,
+                        stderr == subprocess.STDOUT)
+        if out_r is not None:
+            os.close(out_w)
+            self.stdout = os.fdopen(out_r, 'rb')
+        if err_r is not None:
+            os.close(err_w)
+            self.stderr = os.fdopen(err_r, 'rb')
+
+    @staticmethod
+    def _child(doit, args, cwd, targets, out_r, out_w, err_r, err_w,
+               merge):
+        """Run the command in the child and exit."""
+        code = 1
+        try:
+            if cwd is not None:
+                os.chdir(cwd)
+            for fd in (out_r, err_r):
+                if fd is not None:
+                    os.close(fd)
+            if out_w is not None:
+                os.dup2(out_w, 1)
+            if err_w is not None:
+                os.dup2(err_w, 2)
+            elif merge:
+                os.dup2(1, 2)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # Line buffering, so progress can be read as it happens.
+            sys.stdout = os.fdopen(os.dup(1), 'w', 1)
+            sys.stderr = os.fdopen(os.dup(2), 'w', 1)
+            # Plugins are loaded already, do not look for them again.
+            doit.nikola.init_plugins = lambda *args, **kwargs: None
+            if targets is not None:
+                record_targets(targets)
+            code = doit.run(args)
+        except SystemExit as e:
+            code = e.code
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                if code is None:
+                    code = 0
+                os._exit(code if isinstance(code, int) else 1)
+
+    def _set_status(self, status):
+        """Set the return code from a waitpid() status."""
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        else:
+            self.returncode = os.WEXITSTATUS(status)
+
+    def poll(self):
+        """Check if the command has finished."""
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self._set_status(status)
+        return self.returncode
+
+    def wait(self):
+        """Wait for the command to finish."""
+        if self.returncode is None:
+            self._set_status(os.waitpid(self.pid, 0)[1])
+        return self.returncode
+
+    def terminate(self):
+        """Terminate the command."""
+        if self.returncode is None:
+            os.kill(self.pid, signal.SIGTERM)
+
+    def communicate(self):
+        """Read all output and wait for the command to finish."""
+        out = self.stdout.read() if self.stdout else None
+        err = self.stderr.read() if self.stderr else None
+        self.wait()
+        return out, err
+
+
+def warm_site(sitedir):
+    """Get the warm site for a site directory.
+
+    :return: the loaded DoitNikola instance, or None if this process is not
+             a warm worker for ``sitedir``
+    """
+    if _warm is None or _warm.doit is None:
+        return None
+    if os.path.abspath(sitedir) != _warm.sitedir:
+        return None
+    return _warm.doit
+
+
+class WarmWorker(Worker):
+    """An rq worker that keeps the Nikola site loaded.
+
+    Jobs run in a work horse forked from this process, so they start with
+    the site already configured, with plugins and the theme loaded.
+    """
+
+    def execute_job(self, job, *args, **kwargs):
+        """Reload the site if needed, then execute a job."""
+        if _warm is not None:
+            _warm.refresh(self.log)
+        return super(WarmWorker, self).execute_job(job, *args, **kwargs)
+
+
+class _NoDeathPenalty(BaseDeathPenalty):
+    """Job timeouts use SIGALRM, which only works in the main thread."""
+
+    def setup_death_penalty(self):
+        pass
+
+    def cancel_death_penalty(self):
+        pass
+
+
+class ThreadedWorker(Worker):
+    """An rq worker that runs jobs in threads of a single process.
+
+    Jobs do not change the working directory, so one worker can build
+    several sites at once.  rq cannot enforce job timeouts here; the build
+    tasks terminate Nikola themselves when their job times out, and never
+    work on the same site at once.
+    """
+
+    death_penalty_class = _NoDeathPenalty
+
+    def __init__(self, *args, **kwargs):
+        """Initialize a worker.
+
+        :param int threads: Number of jobs to run at once
+        """
+        threads = kwargs.pop('threads', 4)
+        super(ThreadedWorker, self).__init__(*args, **kwargs)
+        self.slots = threading.BoundedSemaphore(threads)
+        self.threads = set()
+        self.threads_lock = threading.Lock()
+
+    def execute_job(self, job, *args, **kwargs):
+        """Execute a job in a new thread, once a slot is free."""
+        self.slots.acquire()
+        thread = threading.Thread(target=self._run_job, args=(job,))
+        thread.daemon = True
+        with self.threads_lock:
+            self.threads.add(thread)
+        thread.start()
+
+    def _run_job(self, job):
+        """Perform a job and enqueue the jobs depending on it."""
+        try:
+            # The connection stack is local to each thread.
+            with Connection(self.connection):
+                if self.perform_job(job):
+                    # The work loop cannot see the job finish.
+                    queue = Queue(job.origin, connection=self.connection)
+                    queue.enqueue_dependents(job)
+        except Exception:
+            self.log.exception("Job {0} failed.".format(job.id))
+        finally:
+            with self.threads_lock:
+                self.threads.discard(threading.current_thread())
+            self.slots.release()
+
+    def work(self, *args, **kwargs):
+        """Run the work loop, then wait for running jobs."""
+        try:
+            return super(ThreadedWorker, self).work(*args, **kwargs)
+        finally:
+            with self.threads_lock:
+                threads = list(self.threads)
+            if threads:
+                self.log.info("Waiting for {0} job(s).".format(len(threads)))
+            for thread in threads:
+                thread.join()
+
+
+def work(burst=False, threads=0, url=None):
+    """Run a build worker.
+
+    By default, the worker keeps the site in the current directory loaded.
+    With ``threads``, it runs jobs of any number of sites sharing a queue.
+
+    :param bool burst: Quit when the queue is empty
+    :param int threads: Number of jobs to run at once (0 for a warm worker)
+    :param str url: Redis URL of the queue (default: ``COIL_QUEUE_URL`` of
+                    the site)
+    :return: exit code
+    :rtype: int
+    """
+    global _warm
+    if threads:
+        if url is None:
+            print("FATAL: --threads requires --url")
+            return 255
+        db = StrictRedis.from_url(url)
+        with Connection(db):
+            worker = ThreadedWorker([Queue('coil', connection=db)],
+                                    connection=db, threads=threads)
+            worker.work(burst=burst)
+        return 0
+
+    site = WarmSite(os.getcwd())
+    worker_logger = nikola.utils.get_logger('CoilWorker',
+                                            nikola.utils.STDERR_HANDLER)
+    site.refresh(worker_logger)
+    if site.doit is None or not site.doit.nikola.configured:
+        print("FATAL: no conf.py found")
+        return 255
+    config = site.doit.nikola.config
+    if config.get('COIL_LIMITED', False):
+        print("FATAL: the worker is not available in Limited Mode")
+        return 255
+    _warm = site
+    if url is None:
+        url = config.get('COIL_QUEUE_URL', config.get(
+            'COIL_REDIS_URL', 'redis://localhost:6379/0'))
+    db = StrictRedis.from_url(url)
+    with Connection(db):
+        worker = WarmWorker([Queue('coil', connection=db)], connection=db)
+        worker.work(burst=burst)
+    return 0
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Coil CMS v1.2.0
+# Copyright © 2014-2018 Chris Warrick, Roberto Alsina, Henry Hirsch et al.
+
+# Permission is hereby granted, free of charge, to any
+# person obtaining a copy of this software and associated
+# documentation files (the "Software"), to deal in the
+# Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the
+# Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice
+# shall be included in all copies or substantial portions of
+# the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY
+# KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE
+# WARRANTIES OF MERCHANTABILITY, FITNESS FOR A PARTICULAR
+# PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS
+# OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR
+# OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR
+# OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+
+"""Tests for the site database lock.
+
+They need a Redis server; set ``COIL_TEST_REDIS_URL`` to a database that may
+be wiped (eg. ``redis://localhost:6379/15``).
+"""
+
+from __future__ import unicode_literals
+import logging
+import os
+import time
+import pytest
+import redis
+from coil.utils import SiteLock
+
+REDIS_URL = os.environ.get('COIL_TEST_REDIS_URL')
+pytestmark = pytest.mark.skipif(REDIS_URL is None,
+                                reason="COIL_TEST_REDIS_URL is not set")
+
+
+@pytest.fixture
+def db():
+    """Get an empty test database."""
+    db = redis.StrictRedis.from_url(REDIS_URL)
+    db.flushdb()
+    yield db
+    db.flushdb()
+
+
+def _lock(db, timeout=120):
+    return SiteLock(db, logging.getLogger('coil.tests'), timeout=timeout)
+
+
+def test_acquire_release(db):
+    lock = _lock(db)
+    with lock:
+        assert lock.holds(db)
+        assert 0 < db.pttl('site:lock') <= 120000
+    assert not db.exists('site:lock')
+    assert lock.token is None
+
+
+def test_legacy_unlocked(db):
+    # Older Coil versions left "0" without an expiry when unlocked.
+    db.set('site:lock', '0')
+    lock = _lock(db)
+    start = time.time()
+    with lock:
+        assert lock.holds(db)
+    assert time.time() - start < 1
+
+
+def test_legacy_locked(db):
+    # A holder from an older Coil version: wait, but not forever.
+    db.set('site:lock', '1')
+    lock = _lock(db, timeout=1)
+    start = time.time()
+    with lock:
+        assert lock.holds(db)
+    assert time.time() - start < 5